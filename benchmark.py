@@ -0,0 +1,254 @@
+"""Benchmarks of the SM-EF model fits and of the K-scale data loaders on synthetic data (offline, JSON report)"""
+
+import sys
+import os
+import time
+import json
+import shutil
+import argparse
+import functools
+import tempfile
+import platform
+import resource
+import tracemalloc
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import read_data
+import file_index
+from landatmospherecoupling import fit_models_grid
+from compute_sm_ef_models import fit_column, compute_sm_ef_models
+
+
+### CST ###
+
+SEASON = 'winter'   # outdir_20200120T0000Z
+DRIVING = 'GAL9'
+REGION = 'africa'
+RESOLUTION = 'km2p2'
+PHYSICS = 'RAL3'   # lam_africa_km2p2_RAL3p2
+
+VARNAMES = {'smc': 'moisture_content_of_soil_layer', 'lhfx': 'surface_upward_latent_heat_flux', 'shfx': 'surface_upward_sensible_heat_flux', 'precip': 'precipitation_rate'}
+
+
+### FUNC ###
+
+def make_sm_ef(nlat=20, nlon=20, ntime=60, noise=0.02, seed=0):
+    """Make daily (time, latitude, longitude) SM and EF following a dry-to-transitional-to-wet regime with known wilting and critical points"""
+    rng = np.random.default_rng(seed)
+    wilt = rng.uniform(10., 15., (nlat, nlon))
+    crit = rng.uniform(25., 30., (nlat, nlon))
+    sm = rng.uniform(5., 40., (ntime, nlat, nlon))
+    ef = 0.1 + 0.6 * (np.clip(sm, wilt, crit) - wilt) / (crit - wilt) + rng.normal(0., noise, sm.shape)
+    coords = {'time': pd.date_range('2020-02-01', periods=ntime, freq='1D'), 'latitude': np.linspace(-35., 5., nlat), 'longitude': np.linspace(-20., 55., nlon)}
+    dims = ('time', 'latitude', 'longitude')
+    sm = xr.DataArray(sm, coords=coords, dims=dims, name='smc')
+    ef = xr.DataArray(ef, coords=coords, dims=dims, name='ef')
+    truth = xr.Dataset({'wilt': (('latitude', 'longitude'), wilt), 'crit': (('latitude', 'longitude'), crit)}, coords={'latitude': coords['latitude'], 'longitude': coords['longitude']})
+    return sm, ef, truth
+
+def make_tree(root, nlat=50, nlon=50, ndays=10, ntime=8, ndepth=4, start='2020-02-01', seed=0):
+    """Write a synthetic K-scale tree (outdir_*/DMn1280*/lam_*/{single_smc,single_lhfx,single_shfx,precip}) of sub-daily files and return its size in bytes"""
+    rng = np.random.default_rng(seed)
+    path = root + '/outdir_20200120T0000Z/DMn1280' + DRIVING + '/lam_' + REGION + '_' + RESOLUTION + '_' + PHYSICS + 'p2'
+    lats = np.linspace(-35., 5., nlat)
+    lons = np.linspace(-20., 55., nlon)
+    out = 0
+    for variable, varname in VARNAMES.items():
+        if variable == 'precip':
+            varpath = path + '/precip'
+        else:
+            varpath = path + '/single_' + variable
+        os.makedirs(varpath, exist_ok=True)
+        for day in pd.date_range(start, periods=ndays, freq='1D'):
+            coords = {'time': pd.date_range(day, periods=ntime, freq='%ih'%(24 // ntime)), 'latitude': lats, 'longitude': lons}
+            if variable == 'smc':
+                data = rng.uniform(5., 40., (ntime, ndepth, nlat, nlon)).astype(np.float32)
+                dims = ('time', 'depth', 'latitude', 'longitude')
+                coords['depth'] = np.arange(ndepth)
+            elif variable == 'precip':
+                data = rng.exponential(1e-4, (ntime, nlat, nlon)).astype(np.float32)
+                dims = ('time', 'latitude', 'longitude')
+            else:
+                data = rng.uniform(-20., 300., (ntime, nlat, nlon)).astype(np.float32)
+                dims = ('time', 'latitude', 'longitude')
+            datafile = varpath + '/' + day.strftime('%Y%m%d') + 'T0000Z_' + os.path.basename(varpath) + '.nc'
+            xr.Dataset({varname: (dims, data)}, coords=coords).to_netcdf(datafile)
+            out = out + os.path.getsize(datafile)
+    return out
+
+def use_tree(root, indexfile):
+    """Point the read_data loaders at a synthetic K-scale tree (without Zarr stores) and its own file index, away from the one of KSCALEOUTDIR"""
+    read_data.KSCALEDATA = root
+    read_data.get_datafile = functools.partial(file_index.get_datafile, indexfile=indexfile)
+    read_data.KSCALEOUTDIR = root + '/out'
+    read_data.get_path_global.cache_clear()
+    read_data.get_path_channel.cache_clear()
+    read_data.get_path_lam.cache_clear()
+
+def measure(func, *args, **kwargs):
+    """Run a function once untraced for its wall time and once under tracemalloc for its peak Python heap"""
+    t0 = time.perf_counter()
+    func(*args, **kwargs)
+    seconds = time.perf_counter() - t0
+    tracemalloc.start()
+    func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    out = {'seconds': seconds, 'peak_mb': peak / 1e6}
+    return out
+
+def get_maxrss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident set size (kilobytes on Linux, bytes on macOS)"""
+    maxrss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        out = maxrss / 1e6
+    else:
+        out = maxrss / 1e3
+    return out
+
+
+#~~~ FITS ~~~#
+
+def fit_columns(sm, ef, min_days=10):
+    """Fit every column with LACR, one column at a time"""
+    out = [fit_column(sm[:, i, j], ef[:, i, j], min_days) for i in range(sm.shape[1]) for j in range(sm.shape[2])]
+    return out
+
+def bench_lacr(nlat=10, nlon=10, ntime=60):
+    """Per-column LACR fits"""
+    sm, ef, truth = make_sm_ef(nlat, nlon, ntime)
+    out = measure(fit_columns, sm.values, ef.values)
+    out['columns'] = nlat * nlon
+    out['columns_per_s'] = out['columns'] / out['seconds']
+    return out
+
+def bench_tiles(workdir, nlat=20, nlon=20, ntime=60, tile_size=10, nworkers=2):
+    """Tile-parallel LACR fits with the compute_sm_ef_models driver (peak memory of the workers is in maxrss_children_mb)"""
+    sm, ef, truth = make_sm_ef(nlat, nlon, ntime)
+    tiledir = workdir + '/tiles'
+    outfile = workdir + '/sm_ef_models.nc'
+    def run():
+        shutil.rmtree(tiledir, ignore_errors=True)
+        compute_sm_ef_models(sm, ef, tiledir, outfile, tile_size, nworkers)
+    out = measure(run)
+    out['columns'] = nlat * nlon
+    out['columns_per_s'] = out['columns'] / out['seconds']
+    out['nworkers'] = nworkers
+    out['tile_size'] = tile_size
+    return out
+
+def bench_batch(nlat=20, nlon=20, ntime=60):
+    """Vectorized fits of every column at once, with the error on the recovered breakpoints"""
+    sm, ef, truth = make_sm_ef(nlat, nlon, ntime)
+    out = measure(fit_models_grid, sm, ef)
+    ds = fit_models_grid(sm, ef)
+    dtw = (ds.number == 4)
+    out['columns'] = nlat * nlon
+    out['columns_per_s'] = out['columns'] / out['seconds']
+    out['dtw_frac'] = float(dtw.mean())
+    out['wilt_mae'] = float(abs(ds.wilt - truth.wilt).where(dtw).mean())
+    out['crit_mae'] = float(abs(ds.crit - truth.crit).where(dtw).mean())
+    return out
+
+
+#~~~ I/O ~~~#
+
+def bench_file_lookup(root, indexfile, ndays=10, start='2020-02-01'):
+    """Index the synthetic tree (cold: scan + database, warm: database only) and look up every daily file in memory"""
+    path = read_data.get_path_lam(SEASON, DRIVING, REGION, RESOLUTION, PHYSICS)
+    varpaths = [path + '/single_smc', path + '/single_lhfx', path + '/single_shfx', path + '/precip']
+    dates = [date.strftime('%Y%m%d') for date in pd.date_range(start, periods=ndays, freq='1D')]
+    t0 = time.perf_counter()
+    for varpath in varpaths:
+        file_index.get_dir_index(varpath, indexfile, refresh=True)
+    cold = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for varpath in varpaths:
+        file_index._index.pop(varpath)
+        file_index.get_dir_index(varpath, indexfile)
+    warm = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for varpath in varpaths:
+        for date in dates:
+            file_index.get_datafile(varpath, date, indexfile)
+    lookup = time.perf_counter() - t0
+    out = {'dirs': len(varpaths), 'files': len(varpaths) * ndays, 'index_cold_s': cold, 'index_warm_s': warm,
+           'lookups_per_s': len(varpaths) * ndays / lookup}
+    return out
+
+def load_days(variable='smc', ndays=10, start='2020-02-01'):
+    """Load a variable day by day with the single-day loaders"""
+    out = [read_data.load_data_domain('lam', SEASON, DRIVING, REGION, RESOLUTION, PHYSICS, variable, date.year, date.month, date.day).load()
+           for date in pd.date_range(start, periods=ndays, freq='1D')]
+    return out
+
+def load_range(variable='smc', ndays=10, start='2020-02-01'):
+    """Load a variable over all days at once with the multi-day loader"""
+    end = (pd.Timestamp(start) + pd.Timedelta(days=ndays - 1)).strftime('%Y-%m-%d')
+    out = read_data.load_data_range('lam', SEASON, DRIVING, REGION, RESOLUTION, PHYSICS, variable, start, end).load()
+    return out
+
+def bench_load(ndays=10, variables=['smc', 'lhfx', 'precip']):
+    """Multi-day loading throughput of the raw files, per-day loop vs. load_data_range"""
+    out = {}
+    for variable in variables:
+        nbytes = load_range(variable, ndays).nbytes
+        res = {'mb': nbytes / 1e6}
+        for name, func in [('days', load_days), ('range', load_range)]:
+            res[name] = measure(func, variable, ndays)
+            res[name]['mb_per_s'] = res['mb'] / res[name]['seconds']
+        out[variable] = res
+    return out
+
+
+#~~~ SUITE ~~~#
+
+def run_benchmarks(sizes=[10, 20, 40], ntime=60, ndays=10, tile_size=10, nworkers=2, workdir=None):
+    """Run every benchmark at several grid sizes (nlat = nlon = size) and return the results as a JSON-serializable dict"""
+    tmpdir = tempfile.mkdtemp(prefix='upscale_bench_', dir=workdir)
+    try:
+        out = {'date': pd.Timestamp.now().isoformat(timespec='seconds'), 'python': platform.python_version(), 'numpy': np.__version__,
+               'xarray': xr.__version__, 'machine': platform.machine(), 'ncpu': os.cpu_count(), 'ntime': ntime, 'ndays': ndays, 'sizes': {}}
+        for size in sizes:
+            print('size %i'%size, flush=True)
+            root = tmpdir + '/DATA_%i'%size
+            res = {}
+            res['lacr'] = bench_lacr(size, size, ntime)
+            res['tiles'] = bench_tiles(tmpdir, size, size, ntime, tile_size, nworkers)
+            res['batch'] = bench_batch(size, size, ntime)
+            res['tree_mb'] = make_tree(root, size, size, ndays) / 1e6
+            indexfile = tmpdir + '/file_index.sqlite'
+            use_tree(root, indexfile)
+            res['file_lookup'] = bench_file_lookup(root, indexfile, ndays)
+            res['load'] = bench_load(ndays)
+            out['sizes'][str(size)] = res
+        out['maxrss_mb'] = get_maxrss_mb()
+        out['maxrss_children_mb'] = get_maxrss_mb(resource.RUSAGE_CHILDREN)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return out
+
+
+### MAIN ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark SM-EF fits and data loading on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 20, 40], help='grid sizes (nlat = nlon)')
+    parser.add_argument('--ntime', type=int, default=60, help='number of days of the SM-EF series')
+    parser.add_argument('--ndays', type=int, default=10, help='number of daily files of the synthetic tree')
+    parser.add_argument('--tile_size', type=int, default=10)
+    parser.add_argument('--nworkers', type=int, default=2)
+    parser.add_argument('--workdir', type=str, default=None, help='directory of the temporary files')
+    parser.add_argument('--output', type=str, default=None, help='JSON file of the results')
+    args = parser.parse_args()
+
+    res = run_benchmarks(args.sizes, args.ntime, args.ndays, args.tile_size, args.nworkers, args.workdir)
+    report = json.dumps(res, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+        print('Saved: %s'%args.output)
+    else:
+        print(report)
@@ -0,0 +1,115 @@
+"""Multiresolution pyramid of the daily outputs: land-weighted block means at 2x, 4x, 8x... the model grid spacing"""
+
+import sys
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from read_data import load_var_domain, get_var_path
+from write_data import make_dir, append_daily_netcdf
+from land_mask import get_land_mask
+from p_config import regions
+
+
+### CST ###
+
+LEVELS = [2, 4, 8]
+
+VARIABLES = ['smc', 'ef', 'precip']
+
+
+### FUNC ###
+
+def get_pyramid_file(season='summer', driving='RAL3', domain='lam', resolution='km2p2', physics='RAL3', variable='ef', level=2):
+    """Get the file of a coarse level of a daily output (<variable>_daily_x<level>.nc, next to <variable>_daily.nc)"""
+    datapath = get_var_path(season, driving, domain, resolution, physics, variable)
+    out = datapath + '/' + variable + '_daily_x' + str(level) + '.nc'
+    return out
+
+def block_sum(values, factor):
+    """Sum a (latitude, longitude) array over blocks of factor x factor cells (incomplete blocks at the edges are dropped)"""
+    nlat = values.shape[-2] // factor
+    nlon = values.shape[-1] // factor
+    values = values[..., :nlat*factor, :nlon*factor]
+    out = values.reshape(values.shape[:-2] + (nlat, factor, nlon, factor)).sum(axis=(-3, -1))
+    return out
+
+def block_coord(x, factor):
+    """Centres of the blocks of a 1D coordinate"""
+    n = len(x) // factor
+    out = np.asarray(x[:n*factor], dtype=np.float64).reshape(n, factor).mean(axis=1)
+    return out
+
+def coarse_grain(da, mask, levels=LEVELS):
+    """Land-weighted block means of a (latitude, longitude) field at each level (multiple of the previous one), from running block sums of values and weights"""
+    weights = np.asarray(mask) & np.isfinite(da.values)
+    sums = np.where(weights, da.values, 0.)
+    weights = weights.astype(np.float64)
+    land = np.asarray(mask).astype(np.float64)
+    lats = da.latitude.values
+    lons = da.longitude.values
+    prev = 1
+    out = {}
+    for level in levels:
+        factor = level // prev
+        sums = block_sum(sums, factor)
+        weights = block_sum(weights, factor)
+        land = block_sum(land, factor)
+        lats = block_coord(lats, factor)
+        lons = block_coord(lons, factor)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            data = sums / weights
+        coords = {'latitude': lats, 'longitude': lons, 'land_frac': (('latitude', 'longitude'), land / level**2)}
+        if 'time' in da.coords:
+            coords['time'] = da.time
+        out[level] = xr.DataArray(data, coords=coords, dims=('latitude', 'longitude'), name=da.name, attrs=da.attrs)
+        prev = level
+    return out
+
+def build_pyramid(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='ef', levels=LEVELS,
+                  lat_range=(-90., 90.), lon_range=(-180., 180.)):
+    """Coarse-grain a daily output at every level, one day at a time, in a single read of the full-resolution series"""
+    levels = sorted(levels)
+    for level, prev in zip(levels, [1] + levels[:-1]):
+        if level % prev != 0:
+            raise ValueError('each level must be a multiple of the previous one (%i, %i)'%(prev, level))
+    da = load_var_domain(domain, season, driving, region, resolution, physics, variable, lat_range, lon_range)
+    mask = get_land_mask(da.latitude.values, da.longitude.values, domain, resolution)
+    outfiles = {level: get_pyramid_file(season, driving, domain, resolution, physics, variable, level) for level in levels}
+    for outfile in outfiles.values():
+        if os.path.isfile(outfile + '.tmp'):
+            os.remove(outfile + '.tmp')
+    for it in range(da.sizes['time']):
+        data = da.isel(time=it).load()
+        print(pd.Timestamp(data.time.values).strftime('%Y-%m-%d'), end=' : ', flush=True)
+        for level, coarse in coarse_grain(data, mask, levels).items():
+            append_daily_netcdf(coarse, outfiles[level] + '.tmp', variable)
+    for outfile in outfiles.values():
+        os.replace(outfile + '.tmp', outfile)
+    out = list(outfiles.values())
+    return out
+
+
+### MAIN ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the coarse-grained levels of the daily outputs')
+    parser.add_argument('--season', type=str, default='winter')
+    parser.add_argument('--driving', type=str, default='GAL9')
+    parser.add_argument('--domain', type=str, default='lam', choices=['global', 'channel', 'lam'])
+    parser.add_argument('--region', type=str, default='africa')
+    parser.add_argument('--resolution', type=str, default='km2p2')
+    parser.add_argument('--physics', type=str, default='RAL3')
+    parser.add_argument('--variables', type=str, nargs='+', default=VARIABLES)
+    parser.add_argument('--levels', type=int, nargs='+', default=LEVELS)
+    args = parser.parse_args()
+
+    lat_range = regions[args.region][0]
+    lon_range = regions[args.region][1]
+
+    for variable in args.variables:
+        print(variable)
+        outfiles = build_pyramid(args.domain, args.season, args.driving, args.region, args.resolution, args.physics, variable, args.levels, lat_range, lon_range)
+        print('\nSaved: %s'%', '.join(outfiles))
@@ -0,0 +1,143 @@
+"""Compare the global, channel and LAM runs on a common grid: domains read concurrently, regridded conservatively with cached weights"""
+
+import sys
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from concurrent.futures import ThreadPoolExecutor
+
+from read_data import load_data_domain
+from land_mask import get_grid_signature
+from write_data import make_dir, write_netcdf
+from p_config import regions
+
+
+### CST ###
+
+DOMAINS = {'global': ('n1280', None), 'channel': ('km4p4', 'RAL3'), 'lam': ('km2p2', 'RAL3')}   # domain -> (resolution, physics), None: physics of the driving model (see get_domains)
+
+_weights = {}   # (source grid signature, target grid signature) -> (latitude weights, longitude weights)
+
+
+### FUNC ###
+
+def get_domains(driving='RAL3', domains=DOMAINS):
+    """Get the (resolution, physics) of each domain for a driving model: the global run is the driving model itself"""
+    out = {domain: (resolution, driving if physics is None else physics) for domain, (resolution, physics) in domains.items()}
+    return out
+
+def get_edges(x):
+    """Cell edges of a 1D grid of cell centres (midpoints, end cells assumed symmetric)"""
+    x = np.asarray(x, dtype=np.float64)
+    mid = (x[1:] + x[:-1]) / 2.
+    out = np.concatenate([[2*x[0] - mid[0]], mid, [2*x[-1] - mid[-1]]])
+    return out
+
+def get_overlap_weights(src, tgt, spherical=False):
+    """(target, source) matrix of the fraction of each target cell covered by each source cell, along one axis (in sin(latitude) if spherical)"""
+    src_edges = get_edges(src)
+    tgt_edges = get_edges(tgt)
+    if spherical:
+        src_edges = np.sin(np.deg2rad(np.clip(src_edges, -90., 90.)))
+        tgt_edges = np.sin(np.deg2rad(np.clip(tgt_edges, -90., 90.)))
+    src_lo = np.minimum(src_edges[:-1], src_edges[1:])
+    src_hi = np.maximum(src_edges[:-1], src_edges[1:])
+    tgt_lo = np.minimum(tgt_edges[:-1], tgt_edges[1:])
+    tgt_hi = np.maximum(tgt_edges[:-1], tgt_edges[1:])
+    overlap = np.minimum(tgt_hi[:, None], src_hi[None, :]) - np.maximum(tgt_lo[:, None], src_lo[None, :])
+    out = np.clip(overlap, 0., None) / (tgt_hi - tgt_lo)[:, None]
+    return out
+
+def get_regrid_weights(lats, lons, tgt_lats, tgt_lons, domain='lam', resolution='km2p2', target='global'):
+    """Separable conservative regridding weights from a source to a target grid, computed once per pair of grids"""
+    key = (get_grid_signature(lats, lons, domain, resolution), get_grid_signature(tgt_lats, tgt_lons, target, 'target'))
+    if key not in _weights:
+        _weights[key] = (get_overlap_weights(lats, tgt_lats, spherical=True), get_overlap_weights(lons, tgt_lons))
+    out = _weights[key]
+    return out
+
+def regrid_conservative(da, tgt_lats, tgt_lons, domain='lam', resolution='km2p2', target='global', min_frac=0.5):
+    """Regrid a (..., latitude, longitude) field conservatively onto a target grid, ignoring missing values; target cells less than min_frac covered by valid data are missing"""
+    wlat, wlon = get_regrid_weights(da.latitude.values, da.longitude.values, tgt_lats, tgt_lons, domain, resolution, target)
+    da = da.transpose(..., 'latitude', 'longitude')
+    values = da.values
+    valid = np.isfinite(values)
+    num = np.matmul(wlat, np.matmul(np.where(valid, values, 0.), wlon.T))
+    frac = np.matmul(wlat, np.matmul(valid.astype(np.float64), wlon.T))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        data = np.where(frac >= min_frac, num / frac, np.nan)
+    coords = {c: da[c] for c in da.coords if ('latitude' not in da[c].dims) and ('longitude' not in da[c].dims)}
+    coords['latitude'] = np.asarray(tgt_lats)
+    coords['longitude'] = np.asarray(tgt_lons)
+    out = xr.DataArray(data, coords=coords, dims=da.dims, name=da.name, attrs=da.attrs)
+    return out
+
+def load_domains(season='summer', driving='RAL3', region='africa', variable='smc', year=2016, month=8, day=1, depth=0, land_only=True, domains=DOMAINS):
+    """Load one day of a variable for several domains concurrently, over the region of p_config, as daily means"""
+    lat_range = regions[region][0]
+    lon_range = regions[region][1]
+    domains = get_domains(driving, domains)
+
+    def load(domain):
+        resolution, physics = domains[domain]
+        da = load_data_domain(domain, season, driving, region, resolution, physics, variable, year, month, day, lat_range, lon_range, depth, land_only)
+        if 'time' in da.dims:
+            da = da.mean('time')
+        out = da.load()
+        return out
+
+    with ThreadPoolExecutor(max_workers=len(domains)) as pool:
+        futures = {domain: pool.submit(load, domain) for domain in domains}
+        out = {domain: future.result() for domain, future in futures.items()}
+    return out
+
+def compare_domains(season='summer', driving='RAL3', region='africa', variable='smc', year=2016, month=8, day=1, depth=0, target='global', land_only=True, domains=DOMAINS, min_frac=0.5):
+    """Daily mean maps of several domains on the grid of the target domain, their differences to it, and their spatial std on the native and target grids"""
+    data = load_domains(season, driving, region, variable, year, month, day, depth, land_only, domains)
+    tgt_lats = data[target].latitude.values
+    tgt_lons = data[target].longitude.values
+    maps = []
+    std_native = []
+    std_target = []
+    for domain, da in data.items():
+        resolution = domains[domain][0]
+        if domain == target:
+            da_tgt = da
+        else:
+            da_tgt = regrid_conservative(da, tgt_lats, tgt_lons, domain, resolution, target, min_frac)
+        maps.append(da_tgt.drop_vars([c for c in da_tgt.coords if c not in ['latitude', 'longitude']]))
+        std_native.append(float(da.std(['latitude', 'longitude'])))
+        std_target.append(float(da_tgt.std(['latitude', 'longitude'])))
+    names = list(data)
+    maps = xr.concat(maps, dim=pd.Index(names, name='domain'))
+    out = xr.Dataset({variable: maps, 'diff': maps - maps.sel(domain=target),
+                      'std_native': ('domain', std_native), 'std_target': ('domain', std_target)})
+    out.attrs['target'] = target
+    out.attrs['date'] = '%04d-%02d-%02d'%(year, month, day)
+    return out
+
+
+### MAIN ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the global, channel and LAM runs on a common grid')
+    parser.add_argument('--season', type=str, default='winter')
+    parser.add_argument('--driving', type=str, default='GAL9')
+    parser.add_argument('--region', type=str, default='africa')
+    parser.add_argument('--variable', type=str, default='smc')
+    parser.add_argument('--depth', type=int, default=0)
+    parser.add_argument('--date', type=str, default='2020-02-01')
+    parser.add_argument('--target', type=str, default='global', choices=list(DOMAINS))
+    parser.add_argument('--outfile', type=str, default=None)
+    args = parser.parse_args()
+
+    date = pd.Timestamp(args.date)
+    ds = compare_domains(args.season, args.driving, args.region, args.variable, date.year, date.month, date.day, args.depth, args.target)
+    print(ds[['std_native', 'std_target']].to_dataframe())
+    if args.outfile is not None:
+        make_dir(os.path.dirname(os.path.abspath(args.outfile)))
+        write_netcdf(ds, args.outfile)
+        print('Saved: %s'%args.outfile)
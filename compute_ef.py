@@ -0,0 +1,110 @@
+"""Compute daily evaporative fraction (EF) from sub-daily surface latent and sensible heat fluxes, one day at a time"""
+
+import sys
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from read_data import load_data_domain, get_var_path, get_file_dates
+from write_data import make_dir, append_daily_netcdf
+from land_mask import get_land_mask
+from land_points import to_points
+from p_config import regions
+
+
+### FUNC ###
+
+def compute_ef(lhdata, shdata):
+    """Compute evaporative fraction"""
+    ef = lhdata / (lhdata + shdata)
+    ef = ef.where((lhdata >= 0.) & (shdata >= 0.))  # compute EF only with both fluxes towards the atmosphere
+    out = ef.where((ef >= 0.) & (ef <= 1.))
+    return out
+
+def accumulate_daily(acc, da):
+    """Add the time steps of a sub-daily field to running daily sums and counts"""
+    for it in range(da.sizes['time']):
+        data = da.isel(time=it)
+        day = pd.Timestamp(data.time.values).floor('D')
+        if day not in acc:
+            acc[day] = [np.zeros(data.shape), np.zeros(data.shape, dtype=int), data.drop_vars('time')]
+        values = data.values
+        valid = np.isfinite(values)
+        acc[day][0][valid] += values[valid]
+        acc[day][1] += valid
+    return acc
+
+def pop_daily_mean(acc, day):
+    """Remove a day from the running sums and return its daily mean"""
+    sums, counts, template = acc.pop(day)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = template.copy(data=sums / counts)
+    out = out.expand_dims(time=[day]).isel(time=0)
+    return out
+
+def pop_daily_sum(acc, day):
+    """Remove a day from the running sums and return its sum of the time steps (NaN where none is valid), as the daily precipitation amount of plot_precip"""
+    sums, counts, template = acc.pop(day)
+    out = template.copy(data=np.where(counts > 0, sums, np.nan))
+    out = out.expand_dims(time=[day]).isel(time=0)
+    return out
+
+def compute_ef_daily(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', start='2016-08-01', end='2016-08-31',
+                     lat_range=(-90., 90.), lon_range=(-180., 180.), outfile=None, points=False):
+    """Compute daily EF between two dates (included) and append it day by day to outfile (default: ef_daily.nc or ef_daily_land.nc of the EF directory), on the grid or as land points"""
+    if outfile is None:
+        outdir = make_dir(get_var_path(season, driving, domain, resolution, physics, 'ef'))
+        outfile = outdir + ('/ef_daily_land.nc' if points else '/ef_daily.nc')
+    tmpfile = outfile + '.tmp'
+    if os.path.isfile(tmpfile):
+        os.remove(tmpfile)
+    acc_lh = {}
+    acc_sh = {}
+    dates = get_file_dates(start, end)
+    for date in dates:
+        print(date.strftime('%Y-%m-%d'), end=' : ', flush=True)
+        try:
+            lh = load_data_domain(domain, season, driving, region, resolution, physics, 'lhfx', date.year, date.month, date.day, lat_range, lon_range, land_only=True)
+            sh = load_data_domain(domain, season, driving, region, resolution, physics, 'shfx', date.year, date.month, date.day, lat_range, lon_range, land_only=True)
+        except KeyError:   # no file before the first or after the last day of the run
+            if date in dates[1:-1]:
+                raise
+        else:   # both fluxes or neither, so that the daily sums of lh and sh hold the same time steps
+            accumulate_daily(acc_lh, lh)
+            accumulate_daily(acc_sh, sh)
+        days = [day for day in sorted(acc_lh) if (day < date) or (date == dates[-1])]   # days that cannot receive more time steps
+        for day in days:
+            lh_d = pop_daily_mean(acc_lh, day)
+            sh_d = pop_daily_mean(acc_sh, day)
+            if (day < pd.Timestamp(start)) or (day > pd.Timestamp(end)):   # partial day of a neighbouring file
+                continue
+            ef = compute_ef(lh_d, sh_d)
+            if points:
+                ef = to_points(ef, get_land_mask(ef.latitude.values, ef.longitude.values, domain, resolution))
+            append_daily_netcdf(ef, tmpfile, 'ef')
+    os.replace(tmpfile, outfile)
+    return outfile
+
+
+### MAIN ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute daily EF')
+    parser.add_argument('--season', type=str, default='winter')
+    parser.add_argument('--driving', type=str, default='GAL9')
+    parser.add_argument('--domain', type=str, default='lam', choices=['global', 'channel', 'lam'])
+    parser.add_argument('--region', type=str, default='africa')
+    parser.add_argument('--resolution', type=str, default='km2p2')
+    parser.add_argument('--physics', type=str, default='RAL3')
+    parser.add_argument('--start', type=str, default='2020-02-01')
+    parser.add_argument('--end', type=str, default='2020-02-28')
+    parser.add_argument('--points', action='store_true', help='store land points only')
+    args = parser.parse_args()
+
+    lat_range = regions[args.region][0]
+    lon_range = regions[args.region][1]
+
+    outfile = compute_ef_daily(args.domain, args.season, args.driving, args.region, args.resolution, args.physics, args.start, args.end, lat_range, lon_range, points=args.points)
+    print('\nSaved: %s'%outfile)
@@ -0,0 +1,199 @@
+"""Map SM-EF coupling regimes over a domain with LACR, tile by tile and in parallel"""
+
+import sys
+import os
+import argparse
+import numpy as np
+import xarray as xr
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+from read_data import *
+from write_data import make_dir, write_netcdf, get_encoding, get_tile_file, check_tile_manifest, merge_tiles
+from landatmospherecoupling import LACR, bootstrap_batch, check_column, STATUS_CODES
+from p_config import regions
+
+
+### CST ###
+
+OUTVARS = ['number', 'wilt', 'crit', 'slope', 'time_frac']
+DIAGVARS = ['status', 'fit_time', 'nfev']
+BOOTVARS = ['wilt_lo', 'wilt_hi', 'crit_lo', 'crit_hi', 'slope_lo', 'slope_hi']
+
+
+### FUNC ###
+
+def load_daily_sm(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', start='2016-08-01', end='2016-08-31', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0, level=1):
+    """Load daily mean SM between two dates (included), from all the time steps of each day (including those in the files of the neighbouring days),
+    or from the coarse-grained daily SM series if level > 1 (which must hold that soil layer)"""
+    if level > 1:
+        data = load_var_domain(domain, season, driving, region, resolution, physics, 'smc', lat_range, lon_range, level=level)
+        if int(data.attrs.get('depth', -1)) != depth:   # soil layer of the daily SM series it was coarse-grained from (daily_stats.py)
+            raise ValueError('coarse-grained SM of soil layer %s, not %i: rebuild the daily SM series with --depth %i'%(data.attrs.get('depth', 'unknown'), depth, depth))
+        out = data.sel(time=slice(start, end))
+    else:
+        data = load_data_range(domain, season, driving, region, resolution, physics, 'smc', start, end, lat_range, lon_range, depth, land_only=True)
+        out = data.resample(time='1D').mean()
+    return out
+
+def load_daily_ef(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), level=1):
+    """Load daily EF computed with compute_ef.ipynb (or its coarse-grained copy)"""
+    if domain == 'global':
+        out = load_var_global(season, driving, resolution, physics, 'ef', lat_range, lon_range, level=level)
+    elif domain == 'channel':
+        out = load_var_channel(season, driving, resolution, physics, 'ef', lat_range, lon_range, level=level)
+    elif domain == 'lam':
+        out = load_var_lam(season, driving, region, resolution, physics, 'ef', lat_range, lon_range, level=level)
+    return out
+
+def get_tiles(nlat, nlon, tile_size=100):
+    """Split a (lat, lon) grid into tiles of index bounds"""
+    out = [(i0, min(i0 + tile_size, nlat), j0, min(j0 + tile_size, nlon)) for i0 in range(0, nlat, tile_size) for j0 in range(0, nlon, tile_size)]
+    return out
+
+def get_run_params(sm, ef, tile_size=100, min_days=10, nboot=0):
+    """Parameters a tile depends on: grid, days, tiling, fit settings and a checksum of the SM and EF inputs"""
+    out = {'latitude': [float(sm.latitude[0]), float(sm.latitude[-1]), sm.sizes['latitude']],
+           'longitude': [float(sm.longitude[0]), float(sm.longitude[-1]), sm.sizes['longitude']],
+           'time': [str(sm.time.values[0]), str(sm.time.values[-1]), sm.sizes['time']],
+           'tile_size': tile_size, 'min_days': min_days, 'nboot': nboot,
+           'sm_sum': float(np.nansum(sm.values)), 'ef_sum': float(np.nansum(ef.values))}
+    return out
+
+def fit_column(sm, ef, min_days=10):
+    """Fit the SM-EF models of one column and return its regime parameters and fit diagnostics (status code, curve_fit time and function evaluations)"""
+    valid = np.isfinite(sm) & np.isfinite(ef)
+    x = sm[valid]
+    y = ef[valid]
+    status = check_column(x, y, min_days)
+    if status != STATUS_CODES['ok']:   # hopeless column: no fit
+        out = {var: np.nan for var in OUTVARS}
+        out.update({'status': status, 'fit_time': 0., 'nfev': 0})
+    else:
+        lacr = LACR(x, y)
+        out = lacr.summary()
+        out.update(lacr.get_diagnostics())
+    return out
+
+
+### WORKER ###
+
+_shared = {}
+
+def init_worker(names, shape, lats, lons):
+    """Attach the shared SM/EF buffers in a worker process"""
+    for var, name in names.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _shared[var] = (shm, np.ndarray(shape, dtype=np.float64, buffer=shm.buf))
+    _shared['latitude'] = lats
+    _shared['longitude'] = lons
+
+def fit_tile(tile, outfile, min_days=10, nboot=0):
+    """Fit every land column of a tile and write its regime map (with bootstrap confidence intervals if nboot > 0, for the parameters estimated where the batch estimator selects the same model)"""
+    i0, i1, j0, j1 = tile
+    sm = _shared['sm'][1][:, i0:i1, j0:j1]
+    ef = _shared['ef'][1][:, i0:i1, j0:j1]
+    out = {var: np.full((i1 - i0, j1 - j0), np.nan) for var in OUTVARS + DIAGVARS}
+    land = np.isfinite(ef).any(axis=0) & np.isfinite(sm).any(axis=0)
+    for i, j in zip(*np.nonzero(land)):
+        res = fit_column(sm[:, i, j], ef[:, i, j], min_days)
+        for var in OUTVARS + DIAGVARS:
+            out[var][i, j] = res[var]
+    if nboot > 0:
+        ilat, ilon = np.nonzero(land)
+        cis = bootstrap_batch(sm[:, ilat, ilon], ef[:, ilat, ilon], nboot, min_days=min_days)
+        same = cis['number'] == out['number'][ilat, ilon]   # intervals of the batch estimator, kept where it selects the model of the stored estimates
+        for var in BOOTVARS:
+            out[var] = np.full((i1 - i0, j1 - j0), np.nan)
+            out[var][ilat, ilon] = np.where(same & np.isfinite(out[var.rsplit('_', 1)[0]][ilat, ilon]), cis[var], np.nan)
+    coords = {'latitude': _shared['latitude'][i0:i1], 'longitude': _shared['longitude'][j0:j1]}
+    ds = xr.Dataset({var: (('latitude', 'longitude'), v) for var, v in out.items()}, coords=coords)
+    write_netcdf(ds, outfile, get_encoding(ds, pack=False))   # only the merged map is packed
+    return outfile
+
+
+### DRIVER ###
+
+def compute_sm_ef_models(sm, ef, tiledir, outfile, tile_size=100, nworkers=None, min_days=10, nboot=0):
+    """Fit SM-EF models over (time, latitude, longitude) SM and EF, tile by tile in parallel; tiles already written by a run with the same inputs and settings are skipped"""
+    sm, ef = xr.align(sm.transpose('time', 'latitude', 'longitude'), ef.transpose('time', 'latitude', 'longitude'), join='inner')
+    sm = sm.load()
+    ef = ef.load()
+    make_dir(tiledir)
+    check_tile_manifest(tiledir, get_run_params(sm, ef, tile_size, min_days, nboot))
+    tiles = get_tiles(sm.sizes['latitude'], sm.sizes['longitude'], tile_size)
+    todo = [tile for tile in tiles if not os.path.isfile(get_tile_file(tiledir, tile[0], tile[2]))]
+    print('%i/%i tiles to fit'%(len(todo), len(tiles)))
+
+    if len(todo) > 0:
+        shms = {}
+        try:
+            for var, data in {'sm': sm, 'ef': ef}.items():
+                shm = shared_memory.SharedMemory(create=True, size=data.size*8)
+                np.ndarray(data.shape, dtype=np.float64, buffer=shm.buf)[:] = data.values
+                shms[var] = shm
+            names = {var: shm.name for var, shm in shms.items()}
+            initargs = (names, sm.shape, sm.latitude.values, sm.longitude.values)
+            with ProcessPoolExecutor(max_workers=nworkers, initializer=init_worker, initargs=initargs) as pool:
+                futures = [pool.submit(fit_tile, tile, get_tile_file(tiledir, tile[0], tile[2]), min_days, nboot) for tile in todo]
+                for n, future in enumerate(as_completed(futures)):
+                    future.result()
+                    print(n+1, end=' : ', flush=True)
+        finally:
+            for shm in shms.values():
+                shm.close()
+                shm.unlink()
+
+    out = merge_tiles([get_tile_file(tiledir, tile[0], tile[2]) for tile in tiles], outfile, add_diagnostics)
+    with xr.open_dataset(out) as ds:
+        print('\nFit status: %s'%', '.join(['%s %i'%(status, count) for status, count in zip(ds.status_name.values, ds.status_count.values)]))
+        print('Fit time: %.1f s, %i function evaluations (%.2f ms, %.1f evaluations per fitted column)'%(float(ds.fit_time.sum()), int(ds.nfev.sum()),
+              1000*float(ds.fit_time.where(ds.nfev > 0).mean()), float(ds.nfev.where(ds.nfev > 0).mean())))
+    return out
+
+def add_diagnostics(ds):
+    """Add the number of columns per fit status to a merged regime map"""
+    counts = [int((ds.status == code).sum()) for code in STATUS_CODES.values()]
+    out = ds.assign(status_count=('status_name', counts)).assign_coords(status_name=list(STATUS_CODES))
+    out.status.attrs['flag_values'] = list(STATUS_CODES.values())
+    out.status.attrs['flag_meanings'] = ' '.join([k.replace(' ', '_') for k in STATUS_CODES])
+    return out
+
+
+### MAIN ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Map SM-EF coupling regimes')
+    parser.add_argument('--season', type=str, default='winter')
+    parser.add_argument('--driving', type=str, default='GAL9')
+    parser.add_argument('--domain', type=str, default='lam', choices=['global', 'channel', 'lam'])
+    parser.add_argument('--region', type=str, default='africa')
+    parser.add_argument('--resolution', type=str, default='km2p2')
+    parser.add_argument('--physics', type=str, default='RAL3')
+    parser.add_argument('--depth', type=int, default=0)
+    parser.add_argument('--start', type=str, default='2020-02-01')
+    parser.add_argument('--end', type=str, default='2020-02-28')
+    parser.add_argument('--tile_size', type=int, default=100)
+    parser.add_argument('--nworkers', type=int, default=None)
+    parser.add_argument('--min_days', type=int, default=10)
+    parser.add_argument('--level', type=int, default=1, help='coarse-graining level (see coarse_grain.py)')
+    parser.add_argument('--nboot', type=int, default=0, help='bootstrap resamples for confidence intervals, refitted with the grid-search estimator of bootstrap_batch (0: none)')
+    args = parser.parse_args()
+
+    lat_range = regions[args.region][0]
+    lon_range = regions[args.region][1]
+
+    print('Load data')
+    sm = load_daily_sm(args.domain, args.season, args.driving, args.region, args.resolution, args.physics, args.start, args.end, lat_range, lon_range, args.depth, args.level)
+    ef = load_daily_ef(args.domain, args.season, args.driving, args.region, args.resolution, args.physics, lat_range, lon_range, args.level)
+
+    outfile = get_sm_ef_models_file(args.season, args.driving, args.domain, args.resolution, args.physics, args.depth, args.level)
+    outdir = make_dir(os.path.dirname(outfile))
+    tiledir = outdir + '/tiles_depth=' + str(args.depth)
+    if args.level > 1:
+        tiledir = tiledir + '_x' + str(args.level)
+
+    print('Fit models')
+    compute_sm_ef_models(sm, ef, tiledir, outfile, args.tile_size, args.nworkers, args.min_days, args.nboot)
+    print('\nSaved: %s'%outfile)
@@ -0,0 +1,235 @@
+"""Incremental daily series of EF, SM and precipitation with running statistics: only the days not processed yet are read"""
+
+import sys
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+
+from read_data import load_data_domain, get_var_path, get_varpath_domain, get_file_dates
+from file_index import get_datafile
+from write_data import make_dir, write_netcdf, append_daily_netcdf
+from compute_ef import compute_ef, accumulate_daily, pop_daily_mean, pop_daily_sum
+from precip_stats import MAXRATE
+from land_mask import get_land_mask
+from land_points import to_points
+from p_config import regions
+
+
+### CST ###
+
+VARIABLES = ['ef', 'smc', 'precip']
+
+WINDOW = 7   # days of the centered rolling mean
+
+
+### FUNC ###
+
+def get_daily_file(season='summer', driving='RAL3', domain='global', resolution='n1280', physics='RAL3', variable='ef', points=False):
+    """Get the daily file of a variable, on the grid (<variable>_daily.nc) or as land points (<variable>_daily_land.nc)"""
+    datapath = get_var_path(season, driving, domain, resolution, physics, variable)
+    if points:
+        out = datapath + '/' + variable + '_daily_land.nc'
+    else:
+        out = datapath + '/' + variable + '_daily.nc'
+    return out
+
+def get_stats_file(dailyfile):
+    """Get the running statistics file of a daily file"""
+    out = dailyfile.replace('.nc', '_stats.nc')
+    return out
+
+def get_rolling_file(dailyfile, window=WINDOW):
+    """Get the rolling mean file of a daily file"""
+    out = dailyfile.replace('.nc', '_rm%i.nc'%window)
+    return out
+
+def get_processed_days(outfile):
+    """Get the days already stored in a daily file (time coordinate only, decoded with its own units)"""
+    if not os.path.isfile(outfile):
+        return pd.DatetimeIndex([])
+    with netCDF4.Dataset(outfile) as nc:
+        time = nc['time']
+        dates = netCDF4.num2date(time[:], time.units, getattr(time, 'calendar', 'standard'), only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+    out = pd.DatetimeIndex(np.atleast_1d(dates)).astype('datetime64[ns]')
+    return out
+
+def iter_daily(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='ef', days=[],
+               lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    """Yield the daily mean of a variable (EF from the daily mean fluxes, precipitation amount: sum of the time steps without fill values) over land
+    for each of the given (consecutive) days, reading only their files and those of the days before and after for the time steps spilling over midnight"""
+    days = pd.DatetimeIndex(days)
+    if len(days) == 0:
+        return
+    if variable == 'ef':
+        sources = ['lhfx', 'shfx']
+    else:
+        sources = [variable]
+    accs = {source: {} for source in sources}
+    dates = get_file_dates(days[0], days[-1])
+    for date in dates:
+        try:
+            for source in sources:
+                da = load_data_domain(domain, season, driving, region, resolution, physics, source, date.year, date.month, date.day, lat_range, lon_range, depth, land_only=True)
+                if source == 'precip':
+                    da = da.where(da < MAXRATE)   # larger rates are fill values
+                accumulate_daily(accs[source], da)
+        except KeyError:   # no file before the first day of the run or after the last day available
+            if date in dates[1:-1]:
+                raise
+        for day in sorted(accs[sources[0]]):
+            if (day < date) or (date == dates[-1]):   # days that cannot receive more time steps
+                means = [pop_daily_sum(accs[source], day) if source == 'precip' else pop_daily_mean(accs[source], day) for source in sources]
+                if day not in days:   # partial day of a neighbouring file
+                    continue
+                if variable == 'ef':
+                    out = compute_ef(*means)
+                else:
+                    out = means[0]
+                yield out
+
+def has_day_file(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='ef', date='2016-08-01'):
+    """Whether the sub-daily files of a variable (lhfx for EF) exist for a day"""
+    varpath = get_varpath_domain(domain, season, driving, region, resolution, physics, 'lhfx' if variable == 'ef' else variable)
+    try:
+        get_datafile(varpath, pd.Timestamp(date).strftime('%Y%m%d'))
+    except KeyError:
+        return False
+    return True
+
+def get_provisional_day(dailyfile):
+    """Get the last day of a daily file if it was computed before the file of the next day existed (some of its time steps may be missing), else None"""
+    if not os.path.isfile(dailyfile):
+        return None
+    with netCDF4.Dataset(dailyfile) as nc:
+        day = getattr(nc, 'provisional_day', '')
+    out = pd.Timestamp(day) if day else None
+    return out
+
+
+#~~~ RUNNING STATISTICS ~~~#
+
+def init_stats(da):
+    """Empty running statistics of a daily field: number of valid days, mean and sum of squared deviations (m2)"""
+    zeros = xr.zeros_like(da.isel(time=0), dtype=float).drop_vars('time')
+    out = xr.Dataset({'count': zeros.astype(np.int32), 'mean': zeros * np.nan, 'm2': zeros * np.nan})
+    out.attrs = {k: v for k, v in da.attrs.items()}
+    out.attrs['last_day'] = ''
+    return out
+
+def merge_stats(stats, da):
+    """Update running statistics with a block of new days (Chan et al. parallel variance)"""
+    values = da.values
+    valid = np.isfinite(values)
+    nb = valid.sum(axis=0)
+    na = stats['count'].values
+    ma = stats['mean'].values
+    m2a = stats['m2'].values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mb = np.where(valid, values, 0.).sum(axis=0) / nb
+        m2b = np.square(np.where(valid, values - mb, 0.)).sum(axis=0)
+        n = na + nb
+        delta = mb - ma
+        mean = np.where(na > 0, ma + delta * nb / n, mb)
+        m2 = np.where(na > 0, m2a + m2b + np.square(delta) * na * nb / n, m2b)
+    mean = np.where(nb > 0, mean, ma)
+    m2 = np.where(nb > 0, m2, m2a)
+    out = stats.copy()
+    out['count'] = stats['count'].copy(data=n.astype(np.int32))
+    out['mean'] = stats['mean'].copy(data=mean)
+    out['m2'] = stats['m2'].copy(data=m2)
+    return out
+
+def update_stats(dailyfile, variable='ef', window=WINDOW):
+    """Update the running statistics and the centered rolling mean of a daily file with the complete days it received since their last update
+    (a provisional last day is left out until it is recomputed)"""
+    statsfile = get_stats_file(dailyfile)
+    rollfile = get_rolling_file(dailyfile, window)
+    days = get_processed_days(dailyfile)
+    if get_provisional_day(dailyfile) is not None:
+        days = days[:-1]
+    if len(days) == 0:
+        return statsfile
+    half = window // 2
+    with xr.open_dataset(dailyfile) as ds:
+        da = ds[variable]
+        if os.path.isfile(statsfile):
+            with xr.open_dataset(statsfile) as ds_stats:
+                stats = ds_stats.load()
+        else:
+            stats = init_stats(da)
+        last = pd.Timestamp(stats.attrs['last_day']) if stats.attrs['last_day'] else None
+        new = np.flatnonzero(days > last) if last is not None else np.arange(len(days))
+        if len(new) > 0:
+            stats = merge_stats(stats, da.isel(time=new).load())
+            stats['std'] = np.sqrt(stats['m2'] / stats['count'])
+            stats.attrs['last_day'] = days[-1].strftime('%Y-%m-%d')
+            write_netcdf(stats, statsfile)
+
+        # centered rolling mean of the days with a full window: only the last window-1 days already stored are read again
+        k0 = half + len(get_processed_days(rollfile))
+        k1 = len(days) - half
+        if k1 > k0:
+            seg = da.isel(time=slice(k0 - half, k1 + half)).load()
+            roll = seg.rolling(time=window, center=True).mean().isel(time=slice(half, half + k1 - k0))
+            for it in range(roll.sizes['time']):
+                append_daily_netcdf(roll.isel(time=it), rollfile, variable)
+    return statsfile
+
+def update_daily(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='ef', start='2016-08-01', end='2016-08-31',
+                 lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0, points=False, window=WINDOW):
+    """Append the days between two dates (included) missing from the daily file of a variable, then update its statistics with these days only"""
+    dailyfile = get_daily_file(season, driving, domain, resolution, physics, variable, points)
+    make_dir(os.path.dirname(dailyfile))
+    done = get_processed_days(dailyfile)
+    provisional = get_provisional_day(dailyfile)
+    days = pd.date_range(start, end, freq='1D')
+    todo = days[~days.isin(done) | (days == provisional)]   # a provisional day is computed again
+    if (provisional is not None) and (len(todo) > 0) and (todo[0] > provisional):
+        todo = pd.DatetimeIndex([provisional]).append(todo)
+    if (len(done) > 0) and (len(todo) > 0) and (todo[0] < done[-1]):
+        raise ValueError('%s already holds days up to %s: days can only be appended after it (remove the file to rebuild it)'%(dailyfile, done[-1].strftime('%Y-%m-%d')))
+    print('%s: %i/%i days to process'%(variable, len(todo), len(days)))
+    for da in iter_daily(domain, season, driving, region, resolution, physics, variable, todo, lat_range, lon_range, depth):
+        print(pd.Timestamp(da.time.values).strftime('%Y-%m-%d'), end=' : ', flush=True)
+        if points:
+            da = to_points(da, get_land_mask(da.latitude.values, da.longitude.values, domain, resolution))
+        if variable == 'smc':
+            da.attrs['depth'] = depth   # soil layer, kept by the coarse-grained levels
+        append_daily_netcdf(da, dailyfile, variable)
+    if len(todo) > 0:
+        last = get_processed_days(dailyfile)[-1]
+        with netCDF4.Dataset(dailyfile, 'a') as nc:
+            nc.provisional_day = '' if has_day_file(domain, season, driving, region, resolution, physics, variable, last + pd.Timedelta('1D')) else last.strftime('%Y-%m-%d')
+    if os.path.isfile(dailyfile):
+        update_stats(dailyfile, variable, window)
+    return dailyfile
+
+
+### MAIN ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Append new days to the daily EF, SM and precipitation series and update their statistics')
+    parser.add_argument('--season', type=str, default='winter')
+    parser.add_argument('--driving', type=str, default='GAL9')
+    parser.add_argument('--domain', type=str, default='lam', choices=['global', 'channel', 'lam'])
+    parser.add_argument('--region', type=str, default='africa')
+    parser.add_argument('--resolution', type=str, default='km2p2')
+    parser.add_argument('--physics', type=str, default='RAL3')
+    parser.add_argument('--variables', type=str, nargs='+', default=VARIABLES, choices=VARIABLES)
+    parser.add_argument('--depth', type=int, default=0, help='soil layer of the SM series')
+    parser.add_argument('--start', type=str, default='2020-02-01')
+    parser.add_argument('--end', type=str, default='2020-02-28')
+    parser.add_argument('--window', type=int, default=WINDOW, help='days of the centered rolling mean')
+    parser.add_argument('--points', action='store_true', help='store land points only')
+    args = parser.parse_args()
+
+    lat_range = regions[args.region][0]
+    lon_range = regions[args.region][1]
+
+    for variable in args.variables:
+        outfile = update_daily(args.domain, args.season, args.driving, args.region, args.resolution, args.physics, variable, args.start, args.end,
+                               lat_range, lon_range, args.depth, args.points, args.window)
+        print('\nSaved: %s'%outfile)
@@ -0,0 +1,79 @@
+"""Index of the K-scale daily files"""
+
+import sys
+import os
+import re
+import sqlite3
+
+from config import KSCALEDATA, KSCALEOUTDIR
+
+
+### CST ###
+
+INDEXFILE = KSCALEOUTDIR + '/file_index.sqlite'
+
+_index = {}   # directory -> (mtime, {date: file name}), refreshed when the directory changes
+
+
+### FUNC ###
+
+def connect(indexfile=INDEXFILE):
+    """Open the index database"""
+    out = sqlite3.connect(indexfile, timeout=60)
+    out.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL)')
+    out.execute('CREATE TABLE IF NOT EXISTS files (dir TEXT, date TEXT, name TEXT, PRIMARY KEY (dir, date))')
+    return out
+
+def scan_dir(varpath):
+    """Map every YYYYMMDD date found in the file names of a directory to the first file (in sorted order) containing it"""
+    out = {}
+    for f in sorted(os.listdir(varpath)):
+        for digits in re.findall(r'\d{8,}', f):
+            for i in range(len(digits) - 7):
+                out.setdefault(digits[i:i+8], f)
+    return out
+
+def get_dir_index(varpath, indexfile=INDEXFILE, refresh=False):
+    """Get the date -> file name index of a directory, rescanning it only if its mtime changed since it was indexed"""
+    mtime = os.stat(varpath).st_mtime
+    if (varpath in _index) and (_index[varpath][0] == mtime) and not refresh:
+        return _index[varpath][1]
+    try:
+        with connect(indexfile) as db:
+            row = db.execute('SELECT mtime FROM dirs WHERE path = ?', (varpath,)).fetchone()
+            if (row is not None) and (row[0] == mtime):
+                out = dict(db.execute('SELECT date, name FROM files WHERE dir = ?', (varpath,)).fetchall())
+            else:
+                out = scan_dir(varpath)
+                db.execute('DELETE FROM files WHERE dir = ?', (varpath,))
+                db.executemany('INSERT INTO files VALUES (?, ?, ?)', [(varpath, date, name) for date, name in out.items()])
+                db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (varpath, mtime))
+        db.close()
+    except sqlite3.Error:   # e.g. read-only output directory: index in memory only
+        out = scan_dir(varpath)
+    _index[varpath] = (mtime, out)
+    return out
+
+def get_datafile(varpath, date, indexfile=INDEXFILE):
+    """Get the file of a directory for a date (YYYYMMDD)"""
+    index = get_dir_index(varpath, indexfile)
+    out = varpath + '/' + index[date]
+    return out
+
+def build_file_index(root=KSCALEDATA, indexfile=INDEXFILE, refresh=False):
+    """Index every variable directory (single_*, precip, profile_*) of the K-scale tree"""
+    out = []
+    for path, dirs, files in os.walk(root):
+        name = os.path.basename(path)
+        if name.startswith('single_') or name.startswith('profile_') or (name == 'precip'):
+            get_dir_index(path, indexfile, refresh)
+            out.append(path)
+            dirs[:] = []
+    return out
+
+
+### MAIN ###
+
+if __name__ == '__main__':
+    varpaths = build_file_index(refresh=True)
+    print('%i directories indexed in %s'%(len(varpaths), INDEXFILE))
@@ -0,0 +1,50 @@
+"""Land masks of the model grids, computed once and cached on disk"""
+
+import sys
+import os
+import uuid
+import hashlib
+import numpy as np
+
+from global_land_mask import is_land
+
+from config import KSCALEOUTDIR
+
+
+### CST ###
+
+LANDMASKDIR = KSCALEOUTDIR + '/land_masks'
+
+_masks = {}   # grid signature -> memory-mapped mask
+
+
+### FUNC ###
+
+def get_grid_signature(lats, lons, domain='lam', resolution='km2p2'):
+    """Identify a (latitude, longitude) grid by its domain, resolution, bounds, shape and coordinate values"""
+    lats = np.ascontiguousarray(lats, dtype=np.float64)
+    lons = np.ascontiguousarray(lons, dtype=np.float64)
+    h = hashlib.sha1(lats.tobytes() + lons.tobytes()).hexdigest()[:12]
+    out = '%s_%s_lat%.2f_%.2f_lon%.2f_%.2f_%ix%i_%s'%(domain, resolution, lats[0], lats[-1], lons[0], lons[-1], len(lats), len(lons), h)
+    return out
+
+def get_land_mask(lats, lons, domain='lam', resolution='km2p2', maskdir=LANDMASKDIR):
+    """Get the (latitude, longitude) land mask of a grid, computed with is_land only the first time the grid is seen"""
+    sig = get_grid_signature(lats, lons, domain, resolution)
+    if sig in _masks:
+        return _masks[sig]
+    maskfile = maskdir + '/' + sig + '.npy'
+    if not os.path.isfile(maskfile):
+        lons_, lats_ = np.meshgrid(lons, lats)
+        mask = is_land(lats_, lons_).astype(np.uint8)
+        os.makedirs(maskdir, exist_ok=True)
+        tmpfile = maskfile + '.' + uuid.uuid4().hex + '.tmp'   # unique: processes on the same grid may write it concurrently
+        with open(tmpfile, 'wb') as f:
+            np.save(f, mask)
+        if os.path.isfile(maskfile):   # written by another process in the meantime
+            os.remove(tmpfile)
+        else:
+            os.replace(tmpfile, maskfile)
+    out = np.load(maskfile, mmap_mode='r').view(bool)
+    _masks[sig] = out
+    return out
@@ -0,0 +1,60 @@
+"""Sparse storage of land columns as (time, point) arrays"""
+
+import sys
+import os
+import numpy as np
+import xarray as xr
+
+
+### FUNC ###
+
+def to_points(da, mask=None):
+    """Keep the columns of a (..., latitude, longitude) field where mask is True (default: columns with any valid value) as a point dimension"""
+    if mask is None:
+        mask = da.notnull().any([dim for dim in da.dims if dim not in ['latitude', 'longitude']])
+    ilat, ilon = np.nonzero(np.asarray(mask))
+    out = da.isel(latitude=xr.DataArray(ilat, dims='point'), longitude=xr.DataArray(ilon, dims='point'))
+    out = out.assign_coords(ilat=('point', ilat.astype(np.int32)), ilon=('point', ilon.astype(np.int32)))
+    out.attrs['grid_latitude'] = get_grid_bounds(da.latitude.values)
+    out.attrs['grid_longitude'] = get_grid_bounds(da.longitude.values)
+    return out
+
+def get_grid_bounds(x):
+    """First value, last value and size of a regular 1D grid"""
+    x = np.asarray(x, dtype=np.float64)
+    out = np.array([x[0], x[-1], len(x)]) if len(x) > 0 else np.array([np.nan, np.nan, 0])
+    return out
+
+def get_grid_coord(bounds, index, values):
+    """Rebuild a regular 1D grid from its bounds, with the exact coordinates of the points where they are known"""
+    bounds = np.atleast_1d(bounds)
+    if len(bounds) != 3:   # full coordinates (files written before the bounds were stored)
+        out = np.asarray(bounds, dtype=np.float64).copy()
+    else:
+        out = np.linspace(bounds[0], bounds[1], int(bounds[2]))
+    out[index] = values
+    return out
+
+def to_grid(da):
+    """Expand a (..., point) field back to its (..., latitude, longitude) grid, lazily if the field is dask-backed"""
+    lats = get_grid_coord(da.attrs['grid_latitude'], da.ilat.values, da.latitude.values)
+    lons = get_grid_coord(da.attrs['grid_longitude'], da.ilon.values, da.longitude.values)
+    nlat = len(lats)
+    nlon = len(lons)
+    npt = da.sizes['point']
+    index = np.full((nlat, nlon), npt)
+    index[da.ilat.values, da.ilon.values] = np.arange(npt)
+    data = da.drop_vars(['latitude', 'longitude', 'ilat', 'ilon'], errors='ignore')
+    shape = [1 if dim == 'point' else data.sizes[dim] for dim in data.dims]
+    fill = xr.DataArray(np.full(shape, np.nan), dims=data.dims, coords={c: data[c] for c in data.coords if 'point' not in data[c].dims})
+    data = xr.concat([data, fill], dim='point')   # index npt points to missing values
+    out = data.isel(point=xr.DataArray(index, dims=('latitude', 'longitude')))
+    out = out.assign_coords(latitude=lats, longitude=lons)
+    out.attrs = {k: v for k, v in da.attrs.items() if k not in ['grid_latitude', 'grid_longitude']}
+    return out
+
+def sel_points(da, lat_range=(-90., 90.), lon_range=(-180., 180.)):
+    """Select the points of a (..., point) field within lat/lon bounds"""
+    inside = (da.latitude >= lat_range[0]) & (da.latitude <= lat_range[1]) & (da.longitude >= lon_range[0]) & (da.longitude <= lon_range[1])
+    out = da.isel(point=np.flatnonzero(inside.values))
+    return out
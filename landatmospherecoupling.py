@@ -2,8 +2,11 @@
 
 import sys
 import os
+import time
+import functools
 import numpy as np
 import pandas as pd
+import xarray as xr
 
 from scipy import optimize
 from scipy.stats import linregress
@@ -11,31 +14,103 @@ from scipy.stats import linregress
 
 ### CST ###
 
+MODELS = ['flat', 'linear', 'dry-to-transitional', 'transitional-to-wet', 'dry-to-transitional-to-wet']
+MODEL_NUMBERS = {'flat': 0, 'linear': 1, 'dry-to-transitional': 2, 'transitional-to-wet': 3, 'dry-to-transitional-to-wet': 4}
+MODEL_NPARAMS = {'flat': 1, 'linear': 2, 'dry-to-transitional': 3, 'transitional-to-wet': 3, 'dry-to-transitional-to-wet': 4}
+STATUS_CODES = {'ok': 0, 'too few days': 1, 'no SM variance': 2, 'not converged': 3, 'bad input': 4}
+
 
 ### FUNC ###
 
 # See https://stackoverflow.com/questions/29382903/how-to-apply-piecewise-linear-fit-in-python
+# Models are written as nested np.where (same branch order and arithmetic as np.piecewise, which returns 0 where no condition holds)
+# and come with their analytical Jacobians for optimize.curve_fit(..., jac=)
 
 def flat_model(x, y0):
     """Make flat model"""
-    out = np.piecewise(x, [x], [lambda x:y0])
+    out = np.full_like(x, y0, dtype=float)   # np.piecewise(x, [x], ...) used x as its condition and returned 0 where x == 0 (SM equal to its mean)
     return out
 
 def piecewise_linear_dt(x, x0, y0, k1):
     """Make piecewise linear model for dry to transitional regimes transition"""
-    out = np.piecewise(x, [x < x0, x >= x0], [lambda x:y0, lambda x:k1*x + y0-k1*x0])
+    out = np.where(x >= x0, k1*x + y0-k1*x0, np.where(x < x0, y0, 0.))
     return out
 
 def piecewise_linear_tw(x, x0, y0, k1):
     """Make piecewise linear model for transitional to wet regimes transition"""
-    out = np.piecewise(x, [x < x0, x >= x0], [lambda x:k1*x + y0-k1*x0, lambda x:y0])
+    out = np.where(x >= x0, y0, np.where(x < x0, k1*x + y0-k1*x0, 0.))
     return out
 
 def piecewise_linear_dtw(x, x0, x1, y0, k1):
     """Make piecewise linear model for dry to transitional to wet regimes transitions"""
-    condlist = [x < x0, np.logical_and(x >= x0, x < x1), x >= x1]
-    funclist = [lambda x: y0, lambda x: k1*(x-x0) + y0, lambda x:k1*(x1-x0) + y0]
-    out = np.piecewise(x, condlist, funclist)
+    out = np.where(x >= x1, k1*(x1-x0) + y0, np.where(x >= x0, k1*(x-x0) + y0, np.where(x < x0, y0, 0.)))
+    return out
+
+def jac_flat_model(x, y0):
+    """Jacobian of the flat model with respect to (y0)"""
+    out = np.ones((len(x), 1))
+    return out
+
+def jac_piecewise_linear_dt(x, x0, y0, k1):
+    """Jacobian of the dry-to-transitional model with respect to (x0, y0, k1)"""
+    out = np.zeros((len(x), 3))
+    dry = x < x0
+    trans = x >= x0
+    out[dry, 1] = 1.
+    out[trans, 0] = -k1
+    out[trans, 1] = 1.
+    out[trans, 2] = x[trans] - x0
+    return out
+
+def jac_piecewise_linear_tw(x, x0, y0, k1):
+    """Jacobian of the transitional-to-wet model with respect to (x0, y0, k1)"""
+    out = np.zeros((len(x), 3))
+    trans = x < x0
+    wet = x >= x0
+    out[trans, 0] = -k1
+    out[trans, 1] = 1.
+    out[trans, 2] = x[trans] - x0
+    out[wet, 1] = 1.
+    return out
+
+def jac_piecewise_linear_dtw(x, x0, x1, y0, k1):
+    """Jacobian of the dry-to-transitional-to-wet model with respect to (x0, x1, y0, k1)"""
+    out = np.zeros((len(x), 4))
+    wet = x >= x1
+    trans = (x >= x0) & ~wet
+    dry = (x < x0) & ~wet
+    out[dry, 2] = 1.
+    out[trans, 0] = -k1
+    out[trans, 2] = 1.
+    out[trans, 3] = x[trans] - x0
+    out[wet, 0] = -k1
+    out[wet, 1] = k1
+    out[wet, 2] = 1.
+    out[wet, 3] = x1 - x0
+    return out
+
+def memoize(method):
+    """Cache the result of an argument-free LACR method on its instance"""
+    @functools.wraps(method)
+    def wrapper(self):
+        name = method.__name__
+        if name not in self._cache:
+            self._cache[name] = method(self)
+        return self._cache[name]
+    return wrapper
+
+def check_column(sm, ef, min_days=5):
+    """Status code of a column before any fit: bad input (shapes, non-finite values), too few days or no SM variance"""
+    sm = np.asarray(sm)
+    ef = np.asarray(ef)
+    if (sm.ndim != 1) or (sm.shape != ef.shape) or not (np.isfinite(sm).all() and np.isfinite(ef).all()):
+        out = STATUS_CODES['bad input']
+    elif len(sm) < max(min_days, MODEL_NPARAMS['dry-to-transitional-to-wet'] + 1):
+        out = STATUS_CODES['too few days']
+    elif sm.std() == 0.:
+        out = STATUS_CODES['no SM variance']
+    else:
+        out = STATUS_CODES['ok']
     return out
 
 def compute_aic_rss(k, n, rss):
@@ -51,57 +126,103 @@ class LACR:
     """Land-Atmosphere Coupling Regime"""
     def __init__(self, sm, ef):
         self.x = sm
-        self.x_std = (self.x - self.x.mean()) / self.x.std()
+        with np.errstate(divide='ignore', invalid='ignore'):   # degenerate columns are caught by get_status
+            self.x_std = (self.x - self.x.mean()) / self.x.std()
         self.y = ef
+        self._cache = {}
+        self.failures = {}   # model -> status code of a failed fit
+        self.nfev = {}   # model -> number of curve_fit function evaluations
+        self.fit_time = {}   # model -> fit time [s]
+
+    def curve_fit(self, model, func, p0, jac):
+        """Fit a model to the standardized SM with optimize.curve_fit, recording its number of function evaluations and its time"""
+        t0 = time.perf_counter()
+        try:
+            p, e, info, msg, ier = optimize.curve_fit(func, self.x_std, self.y, p0=p0, jac=jac, full_output=True)
+            self.nfev[model] = info['nfev']
+        finally:
+            self.fit_time[model] = time.perf_counter() - t0
+        return p
 
+    def seed_breakpoint(self, model, nbreaks=10):
+        """Initial (x0, y0, k1) of a 1-breakpoint model: closed-form linear fits of y on the hinge regressor of candidate breakpoints (SM quantiles)"""
+        x0 = np.quantile(self.x_std, np.linspace(0.1, 0.9, nbreaks))
+        h = hinge_batch(np.asarray(self.x_std)[:, None], x0[None, :], None, model)
+        y0, k1, rss = solve_linear_batch(h, np.asarray(self.y)[:, None], np.ones(h.shape, dtype=bool))
+        if np.isnan(rss).all():   # no usable candidate: start from the linear fit
+            lr = self.fit_linear_model()
+            out = [np.median(self.x_std), lr[0] + lr[1]*np.median(self.x_std), lr[1]]
+        else:
+            i = np.nanargmin(rss)
+            out = [x0[i], y0[i], k1[i]]
+        return out
+
+    def fit_failed(self, model, error, nparams):
+        """Record a failed fit (not converged: RuntimeError, too few days: TypeError of curve_fit with more parameters than days, bad input: ValueError) and return NaN parameters"""
+        if isinstance(error, RuntimeError):
+            self.failures[model] = STATUS_CODES['not converged']
+        elif isinstance(error, TypeError):
+            self.failures[model] = STATUS_CODES['too few days']
+        else:
+            self.failures[model] = STATUS_CODES['bad input']
+        out = [np.nan] * nparams
+        return out
+
+    @memoize
     def fit_flat_model(self):
-        """Fit linear model"""
-        p, e = optimize.curve_fit(flat_model, self.x_std, self.y, p0=[self.y.mean()])
+        """Fit flat model (least squares solution: mean EF)"""
+        p = np.array([self.y.mean()])
         return p
 
+    @memoize
     def fit_linear_model(self):
         """Fit linear model"""
         lr = linregress(self.x_std, self.y)
         out = (lr.intercept, lr.slope)
         return out
 
+    @memoize
     def fit_piecewise_linear_dt(self):
         """Fit dry-to-transitional model"""
         try:
-            p, e = optimize.curve_fit(piecewise_linear_dt, self.x_std, self.y, p0=[self.x_std.mean(), self.y.mean(), 0.01])
-        except:
-            p = [np.nan, np.nan, np.nan]
+            p = self.curve_fit('dry-to-transitional', piecewise_linear_dt, self.seed_breakpoint('dry-to-transitional'), jac_piecewise_linear_dt)
+        except (RuntimeError, ValueError, TypeError) as e:
+            p = self.fit_failed('dry-to-transitional', e, 3)
         return p
 
+    @memoize
     def fit_piecewise_linear_tw(self):
         """Fit transitional-to-wet model"""
         try:
-            p, e = optimize.curve_fit(piecewise_linear_tw, self.x_std, self.y, p0=[self.x_std.mean(), self.y.mean(), 0.01])
-        except:
-            p = [np.nan, np.nan, np.nan]
+            p = self.curve_fit('transitional-to-wet', piecewise_linear_tw, self.seed_breakpoint('transitional-to-wet'), jac_piecewise_linear_tw)
+        except (RuntimeError, ValueError, TypeError) as e:
+            p = self.fit_failed('transitional-to-wet', e, 3)
         return p
 
+    @memoize
     def fit_piecewise_linear_dtw(self):
         """Fit dry-to-transitional-to-wet model"""
-        wilt = self.fit_piecewise_linear_dt()[0]
-        crit = self.fit_piecewise_linear_tw()[0]
+        wilt, y0_, k1_dt = self.fit_piecewise_linear_dt()
+        crit, y1_, k1_tw = self.fit_piecewise_linear_tw()
         diff = crit - wilt
-        y0_ = np.percentile(self.y, 20)
+        k1_ = k1_dt if abs(k1_dt) >= abs(k1_tw) else k1_tw   # seed dtw with the dt dry plateau and the steeper 1-breakpoint slope
         if diff > 0:
             try:
-                p, e = optimize.curve_fit(piecewise_linear_dtw, self.x_std, self.y, p0=[wilt, crit, y0_, 0.01])
-            except:
-                p = [np.nan, np.nan, np.nan, np.nan]
+                p = self.curve_fit('dry-to-transitional-to-wet', piecewise_linear_dtw, [wilt, crit, y0_, k1_], jac_piecewise_linear_dtw)
+            except (RuntimeError, ValueError, TypeError) as e:
+                p = self.fit_failed('dry-to-transitional-to-wet', e, 4)
         else:
             p = [np.nan, np.nan, np.nan, np.nan]
         return p
 
+    @memoize
     def predicted_flat(self):
         """Compute predicted values from flat model"""
         flat = self.fit_flat_model()
-        out = np.array([flat[0] for i in range(len(self.x))])
+        out = np.full(len(self.x), flat[0])
         return out
 
+    @memoize
     def predicted_lr(self):
         """Compute predicted values from linear model"""
         lr = self.fit_linear_model()
@@ -109,6 +230,7 @@ class LACR:
         out = xd * lr[1] + lr[0]
         return out
 
+    @memoize
     def predicted_dt(self):
         """Compute predicted values from dry-to-transitional model"""
         fit_dt = self.fit_piecewise_linear_dt()
@@ -116,6 +238,7 @@ class LACR:
         out = piecewise_linear_dt(xd, *fit_dt)
         return out
 
+    @memoize
     def predicted_tw(self):
         """Compute predicted values from transitional-to-wet model"""
         fit_tw = self.fit_piecewise_linear_tw()
@@ -123,6 +246,7 @@ class LACR:
         out = piecewise_linear_tw(xd, *fit_tw)
         return out
 
+    @memoize
     def predicted_dtw(self):
         """Compute predicted values from dry-to-transitional-to-wet model"""
         fit_dtw = self.fit_piecewise_linear_dtw()
@@ -130,69 +254,77 @@ class LACR:
         out = piecewise_linear_dtw(xd, *fit_dtw)
         return out
 
+    @memoize
     def residuals_flat(self):
         """Compute residuals of the flat model"""
         ymod = self.predicted_flat()
         out = self.y - ymod
         return out
 
+    @memoize
     def residuals_lr(self):
         """Compute residuals of the linear model"""
         ymod = self.predicted_lr()
         out = self.y - ymod
         return out
 
+    @memoize
     def residuals_dt(self):
         """Compute residuals of the dry-to-transitional model"""
         ymod = self.predicted_dt()
         out = self.y - ymod
         return out
 
+    @memoize
     def residuals_tw(self):
         """Compute residuals of the transitional-to-wet model"""
         ymod = self.predicted_tw()
         out = self.y - ymod
         return out
 
+    @memoize
     def residuals_dtw(self):
         """Compute residuals of the dry-to-transitional-to-wet model"""
         ymod = self.predicted_dtw()
         out = self.y - ymod
         return out
 
+    @memoize
     def compute_rss_flat(self):
         """Compute residual sum of squares for linear model"""
         res = self.residuals_flat()
         out = np.sum(np.square(res))
         return out
 
+    @memoize
     def compute_rss_lr(self):
         """Compute residual sum of squares for linear model"""
         res = self.residuals_lr()
         out = np.sum(np.square(res))
         return out
 
+    @memoize
     def compute_rss_dt(self):
         """Compute residual sum of squares for dry-to-transitional piecewise linear model"""
         res = self.residuals_dt()
         out =  np.sum(np.square(res))
         return out
 
+    @memoize
     def compute_rss_tw(self):
         """Compute residual sum of squares for transitional-to-wet piecewise linear model"""
         res = self.residuals_tw()
         out = np.sum(np.square(res))
         return out
 
+    @memoize
     def compute_rss_dtw(self):
         """Compute residual sum of squares for dry-to-transitional-to-wet piecewise linear model"""
         res = self.residuals_dtw()
-        if (np.isnan(res).all() == False):
-            out = np.sum(np.square(res))
-        else:
-            out = 10e12
+        out = np.sum(np.square(res))   # sum(y**2) if the fit failed or was skipped (the model is 0 with NaN parameters)
         return out
 
+    @memoize
     def get_models(self):
         """Get fitted models"""
         out = {'flat': self.fit_flat_model(), 'linear': self.fit_linear_model(),
@@ -201,9 +333,13 @@ class LACR:
                'dry-to-transitional-to-wet': self.fit_piecewise_linear_dtw()}
         return out
 
+    @memoize
     def get_models_aic(self):
-        """Compute model AIC"""
+        """Compute model AIC (the fits of the models a branch does not reach are never run)"""
         aic_flat = compute_aic_rss(1, len(self.x), self.compute_rss_flat())
+        if self.compute_rss_flat() == 0.:   # constant EF: the flat model fits exactly, no other model is tried
+            aics = {'flat': aic_flat, 'linear': np.nan, 'dry-to-transitional': np.nan, 'transitional-to-wet': np.nan, 'dry-to-transitional-to-wet': np.nan}
+            return aics
         aic_lr = compute_aic_rss(2, len(self.x), self.compute_rss_lr())
         fit_lr = self.fit_linear_model()
         k_lr = fit_lr[1]
@@ -213,14 +349,15 @@ class LACR:
             if ((aic_dt < aic_lr) and (abs(aic_dt - aic_lr) > 2)) or ((aic_tw < aic_lr) and (abs(aic_tw - aic_lr) > 2)):  # fit 2-breakpoint model only if one 1-breakpoint model performs significantly better than linear
                 aic_dtw = compute_aic_rss(4, len(self.x), self.compute_rss_dtw())
             else:
-                aic_dtw = 10e6
+                aic_dtw = np.nan
         else:
-            aic_dt = 10e6
-            aic_tw = 10e6
-            aic_dtw = 10e6
+            aic_dt = np.nan
+            aic_tw = np.nan
+            aic_dtw = np.nan   # models not tried are ignored by get_best_model (nanargmin)
         aics =  {'flat': aic_flat, 'linear': aic_lr, 'dry-to-transitional': aic_dt, 'transitional-to-wet': aic_tw, 'dry-to-transitional-to-wet': aic_dtw}
         return aics
 
+    @memoize
     def get_best_model(self):
         """Return model with lowest AIC"""
         aics = self.get_models_aic()
@@ -228,13 +365,14 @@ class LACR:
         best_model = list(aics.keys())[imod]
         return best_model
 
+    @memoize
     def get_best_model_number(self):
         """Return the best model number"""
-        numbers =  {'flat': 0, 'linear': 1, 'dry-to-transitional': 2, 'transitional-to-wet': 3, 'dry-to-transitional-to-wet': 4}
         best_model = self.get_best_model()
-        out = numbers[best_model]
+        out = MODEL_NUMBERS[best_model]
         return out
 
+    @memoize
     def get_best_model_params(self):
         """Get model parameters (with standardized SM values)"""
         mod = self.get_best_model()
@@ -264,6 +402,7 @@ class LACR:
             k = np.nan
         return {'wilt': wilt, 'crit': crit, 'slope': k}
 
+    @memoize
     def get_wilting_point(self):
         """Get wilting point estimated with dry-to-transitional or dry-to-transitional-to-wet model"""
         params = self.get_best_model_params()
@@ -275,6 +414,7 @@ class LACR:
             out = np.nan
         return out
 
+    @memoize
     def get_critical_point(self):
         """Get critical point estimated with dry-to-transitional-to-wet or transitional-to-wet model"""
         params = self.get_best_model_params()
@@ -286,6 +426,7 @@ class LACR:
             out = np.nan
         return out
 
+    @memoize
     def get_slope(self):
         """Get dEF/dSM if a wilting and/or a critical point was founds"""
         params = self.get_best_model_params()
@@ -297,6 +438,7 @@ class LACR:
             out = np.nan
         return out
 
+    @memoize
     def get_transitional_time_frac(self):
         """Compute the fraction of time spent in the transitional regime [%]"""
         mod = self.get_best_model()
@@ -317,3 +459,314 @@ class LACR:
             t_trans = len(x_trans) / len(self.x)
         out = t_trans*100
         return out
+
+    @memoize
+    def get_status(self):
+        """Get the fit status code: failed pre-check (see check_column), not converged if a fit required by the model hierarchy failed, else ok"""
+        out = check_column(self.x, self.y)
+        if out == STATUS_CODES['ok']:
+            self.get_best_model()
+            if len(self.failures) > 0:
+                out = max(self.failures.values())
+        return out
+
+    def summary(self):
+        """Get best model number, wilting point, critical point, slope, transitional time fraction and fit status in one pass"""
+        if check_column(self.x, self.y) != STATUS_CODES['ok']:
+            out = {'number': np.nan, 'wilt': np.nan, 'crit': np.nan, 'slope': np.nan, 'time_frac': np.nan}
+        else:
+            out = {'number': self.get_best_model_number(), 'wilt': self.get_wilting_point(), 'crit': self.get_critical_point(),
+                   'slope': self.get_slope(), 'time_frac': self.get_transitional_time_frac()}
+        out['status'] = self.get_status()
+        return out
+
+    def get_diagnostics(self):
+        """Get the total curve_fit time [s] and function evaluations spent on this column"""
+        out = {'fit_time': sum(self.fit_time.values()), 'nfev': sum(self.nfev.values())}
+        return out
+
+    def get_bootstrap_intervals(self, nboot=100, alpha=0.1, seed=0):
+        """Get confidence intervals of the wilting point, critical point and slope from batched bootstrap resamples (see bootstrap_batch)
+        (the resamples are fitted with the closed-form grid search of fit_models_batch, not with the curve_fit estimator of this class:
+        the intervals are NaN if it does not select the best model of this class on the full sample, or if the parameter is not defined)"""
+        res = bootstrap_batch(np.asarray(self.x)[:, None], np.asarray(self.y)[:, None], nboot, alpha, seed=seed)
+        same = res.pop('number')[0] == self.get_best_model_number()
+        params = {'wilt': self.get_wilting_point(), 'crit': self.get_critical_point(), 'slope': self.get_slope()}
+        out = {k: v[0] if same and np.isfinite(params[k.rsplit('_', 1)[0]]) else np.nan for k, v in res.items()}
+        return out
+
+
+### BATCH ###
+
+# Closed-form counterpart of LACR for many columns at once: each piecewise model is linear in (y0, k1)
+# once its breakpoints are fixed, so breakpoints are grid-searched and segments solved by least squares
+
+def hinge_batch(x, x0, x1, model):
+    """Make the breakpoint regressor h such that model(x) = y0 + k1*h"""
+    if model == 'dry-to-transitional':
+        out = np.maximum(x - x0, 0.)
+    elif model == 'transitional-to-wet':
+        out = np.minimum(x - x0, 0.)
+    elif model == 'dry-to-transitional-to-wet':
+        out = np.minimum(np.maximum(x, x0), x1) - x0
+    return out
+
+def solve_linear_batch(h, y, w):
+    """Least squares fit of y = y0 + k1*h for each column (weights w mask the invalid days)"""
+    h = np.where(w, h, 0.)
+    y = np.where(w, y, 0.)
+    n = w.sum(axis=0)
+    sh = h.sum(axis=0)
+    shh = np.einsum('ij,ij->j', h, h)
+    sy = y.sum(axis=0)
+    shy = np.einsum('ij,ij->j', h, y)
+    det = n*shh - sh**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k1 = np.where(det > 1e-12*n*shh, (n*shy - sh*sy) / det, np.nan)
+        y0 = (sy - k1*sh) / n
+    rss = (w*np.square(y - y0 - k1*h)).sum(axis=0)   # from the residuals: expanding it into the sums above cancels catastrophically for small residuals
+    return y0, k1, rss
+
+def get_linspace_batch(x, w):
+    """Points at which LACR evaluates its models for RSS (predicted_*): np.linspace(x.min(), x.max(), n) over the n valid days of each column,
+    paired with the valid days in their order"""
+    n = w.sum(axis=0)
+    xmin = np.where(w, x, np.inf).min(axis=0)
+    xmax = np.where(w, x, -np.inf).max(axis=0)
+    rank = np.cumsum(w, axis=0) - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = np.where(w, xmin + (xmax - xmin) * rank / np.maximum(n - 1, 1), 0.)
+    return out
+
+def fit_breakpoints_batch(x, y, w, model, nbreaks=20, nrefine=2):
+    """Fit a piecewise linear model for each column by breakpoint grid search with closed-form segments"""
+    npt = x.shape[1]
+    xmin = np.where(w, x, np.inf).min(axis=0)
+    xmax = np.where(w, x, -np.inf).max(axis=0)
+    step = (xmax - xmin) / (nbreaks + 1)
+    lo0 = xmin + step
+    hi0 = xmax - step
+    lo1 = lo0.copy()
+    hi1 = hi0.copy()
+    best = {'x0': np.full(npt, np.nan), 'x1': np.full(npt, np.nan), 'y0': np.full(npt, np.nan), 'k1': np.full(npt, np.nan), 'rss': np.full(npt, np.inf)}
+    for it in range(nrefine + 1):
+        grid0 = np.linspace(lo0, hi0, nbreaks)
+        if model == 'dry-to-transitional-to-wet':
+            grid1 = np.linspace(lo1, hi1, nbreaks)
+            pairs = [(i, j) for i in range(nbreaks) for j in range(nbreaks) if (it > 0) or (i < j)]
+        else:
+            grid1 = grid0
+            pairs = [(i, i) for i in range(nbreaks)]
+        for i, j in pairs:
+            x0 = grid0[i]
+            x1 = grid1[j]
+            y0, k1, rss = solve_linear_batch(hinge_batch(x, x0, x1, model), y, w)
+            better = (rss < best['rss']) & ~np.isnan(k1)
+            if model == 'dry-to-transitional-to-wet':
+                better = better & (x0 < x1)
+            for k, v in zip(['x0', 'x1', 'y0', 'k1', 'rss'], [x0, x1, y0, k1, rss]):
+                best[k] = np.where(better, v, best[k])
+        step = (grid0[1] - grid0[0]) if nbreaks > 1 else step
+        lo0 = np.maximum(best['x0'] - step, xmin)
+        hi0 = np.minimum(best['x0'] + step, xmax)
+        if model == 'dry-to-transitional-to-wet':
+            step1 = (grid1[1] - grid1[0]) if nbreaks > 1 else step
+            lo1 = np.maximum(best['x1'] - step1, xmin)
+            hi1 = np.minimum(best['x1'] + step1, xmax)
+    best['rss'] = np.where(np.isinf(best['rss']), np.nan, best['rss'])
+    return best
+
+def fit_models_batch(sm, ef, nbreaks=20, nrefine=2, min_days=5):
+    """Fit the five SM-EF models of every (time, point) column and select the best one as LACR does: parameters fitted at the observed SM,
+    RSS (and AIC) of the models evaluated on the np.linspace grid of LACR.predicted_* (see get_linspace_batch)"""
+    sm = np.asarray(sm, dtype=float)
+    ef = np.asarray(ef, dtype=float)
+    min_days = max(min_days, MODEL_NPARAMS['dry-to-transitional-to-wet'] + 1)   # as check_column
+    w = np.isfinite(sm) & np.isfinite(ef)
+    n = w.sum(axis=0)
+    w = w & (n >= min_days)
+    n = w.sum(axis=0)
+    npt = sm.shape[1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = np.where(w, sm, 0.).sum(axis=0) / n
+        x_sd = np.sqrt(np.where(w, np.square(sm - x_mean), 0.).sum(axis=0) / n)
+        w = w & (x_sd > 0.)
+        x = np.where(w, (sm - x_mean) / x_sd, 0.)
+    y = np.where(w, ef, 0.)
+    xd = get_linspace_batch(x, w)
+    status = np.select([n < min_days, ~(x_sd > 0.)],
+                       [STATUS_CODES['too few days'], STATUS_CODES['no SM variance']], STATUS_CODES['ok'])
+    n = w.sum(axis=0)
+    valid = n > 0
+
+    out = {}
+    rss = {}
+    #~ flat and linear models
+    y0, k1, _ = solve_linear_batch(x, y, w)
+    rss['linear'] = (w*np.square(y - y0 - k1*xd)).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['flat_y0'] = y.sum(axis=0) / n
+    rss['flat'] = (w*np.square(y - out['flat_y0'])).sum(axis=0)
+    out['linear_intercept'] = y0
+    out['linear_slope'] = k1
+
+    #~ breakpoint models, fitted only where the hierarchy of get_models_aic requires them
+    with np.errstate(divide='ignore', invalid='ignore'):
+        aic = {m: np.full(npt, np.nan) for m in MODELS}
+        aic['flat'] = np.where(valid, compute_aic_rss(MODEL_NPARAMS['flat'], n, rss['flat']), np.nan)
+        aic['linear'] = np.where(valid, compute_aic_rss(MODEL_NPARAMS['linear'], n, rss['linear']), np.nan)
+    fit1 = (aic['linear'] < aic['flat']) & (abs(aic['linear'] - aic['flat']) > 2)
+    fit2 = np.zeros(npt, dtype=bool)
+    names = {'dry-to-transitional': 'dt', 'transitional-to-wet': 'tw', 'dry-to-transitional-to-wet': 'dtw'}
+    for mod, name in names.items():
+        rss[mod] = np.full(npt, np.nan)
+        for p in ['x0', 'x1', 'y0', 'k1']:
+            if (p != 'x1') or (name == 'dtw'):
+                out[name + '_' + p] = np.full(npt, np.nan)
+        if mod == 'dry-to-transitional-to-wet':
+            better_dt = (aic['dry-to-transitional'] < aic['linear']) & (abs(aic['dry-to-transitional'] - aic['linear']) > 2)
+            better_tw = (aic['transitional-to-wet'] < aic['linear']) & (abs(aic['transitional-to-wet'] - aic['linear']) > 2)
+            fit2 = (better_dt | better_tw) & (out['tw_x0'] > out['dt_x0'])
+            idx = np.flatnonzero(fit2)
+        else:
+            idx = np.flatnonzero(fit1)
+        if len(idx) == 0:
+            continue
+        best = fit_breakpoints_batch(x[:, idx], y[:, idx], w[:, idx], mod, nbreaks, nrefine)
+        for p in ['x0', 'x1', 'y0', 'k1']:
+            if (p != 'x1') or (name == 'dtw'):
+                out[name + '_' + p][idx] = best[p]
+        rss[mod][idx] = (w[:, idx]*np.square(y[:, idx] - best['y0'] - best['k1']*hinge_batch(xd[:, idx], best['x0'], best['x1'], mod))).sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            aic[mod][idx] = compute_aic_rss(MODEL_NPARAMS[mod], n[idx], rss[mod][idx])
+
+    #~ best model and its parameters (see LACR.get_best_model_params)
+    aics = np.stack([aic[m] for m in MODELS])
+    has_aic = ~np.isnan(aics).all(axis=0)
+    number = np.full(npt, np.nan)
+    number[has_aic] = np.nanargmin(aics[:, has_aic], axis=0)
+    wilt_std = np.select([number == 2, number == 4], [out['dt_x0'], out['dtw_x0']], np.nan)
+    crit_std = np.select([number == 3, number == 4], [out['tw_x0'], out['dtw_x1']], np.nan)
+    k = np.select([number == 2, number == 3, number == 4], [out['dt_k1'], out['tw_k1'], out['dtw_k1']], np.nan)
+
+    #~ physical breakpoints, slope and transitional time fraction (see LACR.get_wilting_point, ...)
+    x_max = np.where(w, sm, -np.inf).max(axis=0)
+    wilt = x_mean + x_sd*wilt_std
+    wilt = np.where((wilt > 0) & (wilt < x_max), wilt, np.nan)
+    crit = x_mean + x_sd*crit_std
+    crit = np.where((crit > 0) & (crit < x_max), crit, np.nan)
+    slope = np.where(~np.isnan(wilt) | ~np.isnan(crit), k, np.nan)
+    lower = np.where(np.isnan(wilt_std), -np.inf, wilt_std)
+    upper = np.where(np.isnan(crit_std), np.inf, crit_std)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_trans = (w & (x > lower) & (x < upper)).sum(axis=0) / n * 100
+    time_frac = np.where(number >= 2, t_trans, np.nan)
+
+    out['rss'] = np.stack([rss[m] for m in MODELS])
+    out['aic'] = aics
+    out.update({'number': number, 'wilt_std': wilt_std, 'crit_std': crit_std, 'wilt': wilt, 'crit': crit, 'slope': slope, 'time_frac': time_frac, 'status': status})
+    return out
+
+def fit_models_grid(sm, ef, dim='time', nbreaks=20, nrefine=2, min_days=5, chunk_size=10000):
+    """Fit the SM-EF models of every column of (time, ...) SM and EF DataArrays and return them as a Dataset"""
+    sm, ef = xr.align(sm, ef, join='inner')
+    sm = sm.transpose(dim, ...)
+    ef = ef.transpose(*sm.dims)
+    space = sm.dims[1:]
+    shape = sm.shape[1:]
+    x = sm.values.reshape(sm.shape[0], -1)
+    y = ef.values.reshape(ef.shape[0], -1)
+    res = {}
+    for i in range(0, x.shape[1], chunk_size):
+        res_i = fit_models_batch(x[:, i:i+chunk_size], y[:, i:i+chunk_size], nbreaks, nrefine, min_days)
+        for k, v in res_i.items():
+            res.setdefault(k, []).append(v)
+    data_vars = {}
+    for k, v in res.items():
+        v = np.concatenate(v, axis=-1)
+        if v.ndim == 2:
+            data_vars[k] = (('model',) + space, v.reshape((len(MODELS),) + shape))
+        else:
+            data_vars[k] = (space, v.reshape(shape))
+    coords = dict(sm.isel({dim: 0}, drop=True).coords)
+    coords['model'] = MODELS
+    out = xr.Dataset(data_vars, coords=coords)
+    return out
+
+def bootstrap_batch(sm, ef, nboot=100, alpha=0.1, nbreaks=10, nrefine=1, min_days=5, seed=0, chunk_size=10000):
+    """Confidence intervals (alpha/2, 1-alpha/2 quantiles) of the wilting point, critical point and slope of every (time, point) column,
+    from nboot resamples of its valid days fitted all at once with fit_models_batch, and the model it selects on the full sample (number)"""
+    sm = np.asarray(sm, dtype=float)
+    ef = np.asarray(ef, dtype=float)
+    ntime, npt = sm.shape
+    rng = np.random.default_rng(seed)
+    valid = np.isfinite(sm) & np.isfinite(ef)
+    order = np.argsort(~valid, axis=0, kind='stable')   # valid days first
+    n = valid.sum(axis=0)
+    out = {k: np.full(npt, np.nan) for k in ['wilt_lo', 'wilt_hi', 'crit_lo', 'crit_hi', 'slope_lo', 'slope_hi']}
+    step = max(1, chunk_size // nboot)
+    for i in range(0, npt, step):
+        cols = np.arange(i, min(i + step, npt))
+        draws = np.sort(np.floor(rng.random((ntime, nboot, len(cols))) * n[cols]).astype(int), axis=0)   # resampled days kept in time order, as the RSS of LACR pairs them with its np.linspace grid
+        rows = np.take_along_axis(order[:, cols][:, None, :], draws, axis=0)   # (time, boot, point) indices of resampled days
+        keep = np.arange(ntime)[:, None, None] < n[cols]   # resamples have the size of the valid sample
+        x = np.where(keep, sm[rows, cols], np.nan).reshape(ntime, -1)
+        y = np.where(keep, ef[rows, cols], np.nan).reshape(ntime, -1)
+        res = fit_models_batch(x, y, nbreaks, nrefine, min_days)
+        for var in ['wilt', 'crit', 'slope']:
+            samples = res[var].reshape(nboot, len(cols))
+            defined = ~np.isnan(samples).all(axis=0)
+            if defined.any():
+                q = np.nanquantile(samples[:, defined], [alpha/2, 1 - alpha/2], axis=0)
+                out[var + '_lo'][cols[defined]] = q[0]
+                out[var + '_hi'][cols[defined]] = q[1]
+    out['number'] = fit_models_batch(sm, ef, nbreaks, nrefine, min_days)['number']
+    return out
+
+
+### XARRAY ###
+
+REGIME_VARS = ['number', 'wilt', 'crit', 'slope', 'time_frac']
+
+def lacr_gufunc(sm, ef, min_days=5):
+    """Regime parameters (REGIME_VARS) of every (..., time) column of SM and EF with LACR: gufunc of signature (time),(time)->(k)"""
+    sm = np.asarray(sm, dtype=float)
+    ef = np.asarray(ef, dtype=float)
+    out = np.full(sm.shape[:-1] + (len(REGIME_VARS),), np.nan)
+    for idx in np.ndindex(sm.shape[:-1]):
+        valid = np.isfinite(sm[idx]) & np.isfinite(ef[idx])
+        x = sm[idx][valid]
+        y = ef[idx][valid]
+        if check_column(x, y, min_days) == STATUS_CODES['ok']:
+            res = LACR(x, y).summary()
+            out[idx] = [res[var] for var in REGIME_VARS]
+    return out
+
+def batch_gufunc(sm, ef, nbreaks=20, nrefine=2, min_days=5):
+    """Regime parameters (REGIME_VARS) of every (..., time) column of SM and EF with fit_models_batch: gufunc of signature (time),(time)->(k)"""
+    sm = np.asarray(sm, dtype=float)
+    ef = np.asarray(ef, dtype=float)
+    shape = sm.shape[:-1]
+    res = fit_models_batch(sm.reshape(-1, sm.shape[-1]).T, ef.reshape(-1, ef.shape[-1]).T, nbreaks, nrefine, min_days)
+    out = np.stack([res[var] for var in REGIME_VARS], axis=-1).reshape(shape + (len(REGIME_VARS),))
+    return out
+
+def fit_regimes(sm, ef, dim='time', min_days=5):
+    """Map the SM-EF regimes of (time, ...) SM and EF DataArrays with LACR through xr.apply_ufunc (the closed-form batch_gufunc does not always select
+    the same model yet, see test_landatmospherecoupling.py); lazy and parallel over the spatial chunks of dask-backed inputs (time is rechunked into a single chunk)"""
+    sm, ef = xr.align(sm, ef, join='inner')
+    if sm.chunks is not None:
+        sm = sm.chunk({dim: -1})
+    if ef.chunks is not None:
+        ef = ef.chunk({dim: -1})
+    out = xr.apply_ufunc(lacr_gufunc, sm, ef, input_core_dims=[[dim], [dim]], output_core_dims=[['regime']], kwargs={'min_days': min_days},
+                         dask='parallelized', output_dtypes=[float], dask_gufunc_kwargs={'output_sizes': {'regime': len(REGIME_VARS)}})
+    out = out.assign_coords(regime=REGIME_VARS).to_dataset(dim='regime')
+    return out
+
+
+### PROFILING ###
+
+if os.environ.get('UPSCALE_PROFILE'):   # opt-in instrumentation, see profiling.py
+    import profiling
+    profiling.enable_from_env()
@@ -1,3 +1,7 @@
 """K-scale config file"""
 
 regions = {'africa': [(-35., 5.), (-20., 55.)], 'samerica': [(-30., 14.), (-86., -26.)], 'sea': [(-18., 25.), (90., 154.)]}
+
+experiments = {'season': ['summer', 'winter'], 'driving': ['RAL3', 'GAL9'], 'region': ['africa', 'samerica', 'sea']}   # matrix run by run_matrix.py
+
+periods = {'summer': ('2016-08-01', '2016-08-31'), 'winter': ('2020-02-01', '2020-02-28')}
@@ -0,0 +1,207 @@
+"""Precipitation statistics of the global, channel and LAM runs in a single pass over the sub-daily files: wet-day frequency, intensity, quantiles and sub-daily maxima"""
+
+import sys
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from concurrent.futures import ThreadPoolExecutor
+
+from read_data import load_data_domain, get_var_path_season, get_file_dates
+from write_data import make_dir, write_netcdf
+from compare_domains import DOMAINS, get_domains, regrid_conservative
+from p_config import regions
+
+
+### CST ###
+
+MAXRATE = 10000.   # larger rates are fill values
+
+WET = 1.   # wet-day threshold of the daily amount
+
+NBINS = 64
+EDGES = np.geomspace(WET, 1000., NBINS + 1)   # histogram sketch of the wet-day amounts (log-spaced bins, last one open)
+
+QUANTILES = [0.5, 0.9, 0.95, 0.99]
+
+
+### FUNC ###
+
+def get_precip_stats_file(season='summer', driving='RAL3', region='africa', start='2016-08-01', end='2016-08-31'):
+    """Get the file of the precipitation statistics of all domains over a region and a period"""
+    datapath = get_var_path_season(season) + '/precip/DMn1280' + driving
+    out = datapath + '/precip_stats_' + region + '_' + pd.Timestamp(start).strftime('%Y%m%d') + '_' + pd.Timestamp(end).strftime('%Y%m%d') + '.nc'
+    return out
+
+def accumulate_precip(acc, da):
+    """Add the time steps of a sub-daily precipitation field to running daily sums, counts and maxima"""
+    for it in range(da.sizes['time']):
+        data = da.isel(time=it)
+        day = pd.Timestamp(data.time.values).floor('D')
+        if day not in acc:
+            acc[day] = [np.zeros(data.shape), np.zeros(data.shape, dtype=int), np.full(data.shape, np.nan), data.drop_vars('time')]
+        values = data.values
+        valid = np.isfinite(values)
+        acc[day][0][valid] += values[valid]
+        acc[day][1] += valid
+        acc[day][2] = np.fmax(acc[day][2], values)
+    return acc
+
+def pop_daily_precip(acc, day):
+    """Remove a day from the running sums and return its amount (sum of the time steps, as in plot_precip) and its maximum rate"""
+    sums, counts, maxs, template = acc.pop(day)
+    out = (np.where(counts > 0, sums, np.nan), maxs)
+    return out
+
+def init_sketch(template):
+    """Empty precipitation sketch of a (latitude, longitude) field: day counts, totals, maxima and wet-day histogram"""
+    shape = template.shape
+    coords = {'latitude': template.latitude.values, 'longitude': template.longitude.values}
+    dims = ('latitude', 'longitude')
+    out = xr.Dataset({'ndays': (dims, np.zeros(shape, dtype=np.int32)),
+                      'nwet': (dims, np.zeros(shape, dtype=np.int32)),
+                      'total': (dims, np.zeros(shape)),
+                      'wet_total': (dims, np.zeros(shape)),
+                      'max_daily': (dims, np.full(shape, np.nan)),
+                      'max_rate': (dims, np.full(shape, np.nan)),
+                      'hist': (('bin',) + dims, np.zeros((NBINS,) + shape, dtype=np.uint16))},   # up to 65535 wet days per bin
+                     coords=coords)
+    out = out.assign_coords(bin=EDGES[:-1])
+    return out
+
+def update_sketch(sketch, amount, maxrate):
+    """Add one day (daily amount and maximum sub-daily rate arrays) to a sketch, in place"""
+    valid = np.isfinite(amount)
+    wet = valid & (amount >= WET)
+    sketch['ndays'].values += valid
+    sketch['nwet'].values += wet
+    sketch['total'].values += np.where(valid, amount, 0.)
+    sketch['wet_total'].values += np.where(wet, amount, 0.)
+    sketch['max_daily'].values = np.fmax(sketch['max_daily'].values, amount)
+    sketch['max_rate'].values = np.fmax(sketch['max_rate'].values, maxrate)
+    ibin = np.clip(np.searchsorted(EDGES, np.where(wet, amount, WET), side='right') - 1, 0, NBINS - 1)
+    cells = np.flatnonzero(wet)
+    sketch['hist'].values.reshape(NBINS, -1)[ibin.ravel()[cells], cells] += 1
+    return sketch
+
+def merge_sketches(a, b):
+    """Merge the sketches of two periods (or two sets of days) of the same grid"""
+    out = a.copy(deep=True)
+    for var in ['ndays', 'nwet', 'total', 'wet_total', 'hist']:
+        out[var].values += b[var].values
+    for var in ['max_daily', 'max_rate']:
+        out[var].values = np.fmax(a[var].values, b[var].values)
+    return out
+
+def get_sketch_quantiles(sketch, quantiles=QUANTILES):
+    """Quantiles of the wet-day amounts from the histogram sketch (log-linear interpolation within a bin, capped by the wettest day)"""
+    hist = sketch['hist'].values
+    nwet = sketch['nwet'].values
+    cum = np.cumsum(hist, axis=0)
+    lo = np.log(EDGES[:-1])
+    hi = np.log(EDGES[1:])
+    out = []
+    for q in quantiles:
+        target = q * nwet
+        ibin = np.minimum((cum < target[None]).sum(axis=0), NBINS - 1)
+        below = np.where(ibin > 0, np.take_along_axis(cum, np.maximum(ibin - 1, 0)[None], axis=0)[0], 0)
+        count = np.take_along_axis(hist, ibin[None], axis=0)[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.clip((target - below) / count, 0., 1.)
+        value = np.exp(lo[ibin] + frac * (hi[ibin] - lo[ibin]))
+        value = np.fmin(value, sketch['max_daily'].values)
+        out.append(np.where(nwet > 0, value, np.nan))
+    out = xr.DataArray(np.stack(out), coords={'quantile': quantiles, 'latitude': sketch.latitude, 'longitude': sketch.longitude}, dims=('quantile', 'latitude', 'longitude'))
+    return out
+
+def finalize_sketch(sketch, quantiles=QUANTILES):
+    """Precipitation statistics of a sketch: mean daily amount, wet-day frequency, wet-day intensity, wet-day quantiles, maxima"""
+    ndays = sketch['ndays'].where(sketch['ndays'] > 0)
+    nwet = sketch['nwet'].where(sketch['nwet'] > 0)
+    out = xr.Dataset({'mean': sketch['total'] / ndays,
+                      'wet_freq': sketch['nwet'] / ndays,
+                      'intensity': sketch['wet_total'] / nwet,
+                      'quantiles': get_sketch_quantiles(sketch, quantiles),
+                      'max_daily': sketch['max_daily'],
+                      'max_rate': sketch['max_rate'],
+                      'ndays': sketch['ndays']})
+    out.attrs['wet_threshold'] = WET
+    return out
+
+def stream_precip(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', start='2016-08-01', end='2016-08-31',
+                  lat_range=(-90., 90.), lon_range=(-180., 180.), target='global', tgt_lats=None, tgt_lons=None, min_frac=0.5):
+    """Sketch the precipitation of a domain between two dates (included), reading each sub-daily file once (and those of the days before and after
+    for the time steps spilling over midnight); each time step is regridded onto the grid of a target domain if tgt_lats/tgt_lons are given,
+    so that the daily amounts and maximum rates are those of the target grid"""
+    acc = {}
+    sketch = None
+    dates = get_file_dates(start, end)
+    for date in dates:
+        try:
+            da = load_data_domain(domain, season, driving, region, resolution, physics, 'precip', date.year, date.month, date.day, lat_range, lon_range, land_only=True).load()
+            da = da.where(da < MAXRATE)
+            if tgt_lats is not None:
+                da = regrid_conservative(da, tgt_lats, tgt_lons, domain, resolution, target, min_frac)
+            accumulate_precip(acc, da)
+        except KeyError:   # no file before the first day of the run or after the last day available
+            if date in dates[1:-1]:
+                raise
+        for day in sorted(acc):
+            if (day < date) or (date == dates[-1]):   # days that cannot receive more time steps
+                template = acc[day][3]
+                amount, maxrate = pop_daily_precip(acc, day)
+                if (day < pd.Timestamp(start)) or (day > pd.Timestamp(end)):   # partial day of a neighbouring file
+                    continue
+                if sketch is None:
+                    sketch = init_sketch(template)
+                update_sketch(sketch, amount, maxrate)
+    out = sketch
+    return out
+
+def compute_precip_stats(season='summer', driving='RAL3', region='africa', start='2016-08-01', end='2016-08-31', target='global', domains=DOMAINS, quantiles=QUANTILES, min_frac=0.5):
+    """Precipitation statistics of several domains, each streamed once (concurrently), from their time steps regridded onto the grid of the target domain"""
+    lat_range = regions[region][0]
+    lon_range = regions[region][1]
+    domains = get_domains(driving, domains)
+    date = pd.Timestamp(start)
+    grid = load_data_domain(target, season, driving, region, domains[target][0], domains[target][1], 'precip', date.year, date.month, date.day, lat_range, lon_range)
+    tgt_lats = grid.latitude.values
+    tgt_lons = grid.longitude.values
+
+    def stream(domain):
+        resolution, physics = domains[domain]
+        if domain == target:
+            out = stream_precip(domain, season, driving, region, resolution, physics, start, end, lat_range, lon_range)
+        else:
+            out = stream_precip(domain, season, driving, region, resolution, physics, start, end, lat_range, lon_range, target, tgt_lats, tgt_lons, min_frac)
+        return out
+
+    with ThreadPoolExecutor(max_workers=len(domains)) as pool:
+        futures = {domain: pool.submit(stream, domain) for domain in domains}
+        stats = {domain: finalize_sketch(future.result(), quantiles) for domain, future in futures.items()}
+    out = xr.concat(list(stats.values()), dim=pd.Index(list(stats), name='domain'))
+    out.attrs['target'] = target
+    out.attrs['period'] = '%s/%s'%(start, end)
+    return out
+
+
+### MAIN ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precipitation statistics of the global, channel and LAM runs in a single pass over the sub-daily files')
+    parser.add_argument('--season', type=str, default='winter')
+    parser.add_argument('--driving', type=str, default='GAL9')
+    parser.add_argument('--region', type=str, default='africa')
+    parser.add_argument('--start', type=str, default='2020-02-01')
+    parser.add_argument('--end', type=str, default='2020-02-28')
+    parser.add_argument('--target', type=str, default='global', choices=list(DOMAINS))
+    parser.add_argument('--quantiles', type=float, nargs='+', default=QUANTILES)
+    args = parser.parse_args()
+
+    ds = compute_precip_stats(args.season, args.driving, args.region, args.start, args.end, args.target, DOMAINS, args.quantiles)
+    outfile = get_precip_stats_file(args.season, args.driving, args.region, args.start, args.end)
+    make_dir(os.path.dirname(outfile))
+    write_netcdf(ds, outfile)
+    print('Saved: %s'%outfile)
@@ -0,0 +1,235 @@
+"""Opt-in profiling of the data loaders and SM-EF fits: wall time, calls and bytes read per function, as JSON and collapsed stacks
+
+Enable it for a whole run with the UPSCALE_PROFILE environment variable (report prefix, or 1 for ./upscale_profile):
+    UPSCALE_PROFILE=run1 python compute_sm_ef_models.py ...
+worker processes (e.g. the tile fits) then write their own report (<prefix>.<pid>.json), merged into the report of the main process at exit;
+or around a block of code (this process only):
+    with profile('run1'):
+        ...
+"""
+
+import sys
+import os
+import glob
+import json
+import time
+import atexit
+import threading
+import functools
+import contextlib
+import multiprocessing
+import multiprocessing.util
+
+
+### CST ###
+
+ENVVAR = 'UPSCALE_PROFILE'
+
+MODULES = ['read_data', 'file_index', 'land_mask']   # every function defined in these modules is instrumented
+LIBRARY = [('os', 'listdir'), ('xarray', 'open_dataset'), ('xarray', 'open_mfdataset'), ('xarray', 'open_zarr'),
+           ('land_mask', 'is_land'), ('scipy.optimize', 'curve_fit')]   # library calls the loaders and fits spend time in
+
+_stats = {}   # call stack (tuple of names) -> [calls, seconds, bytes read]
+_patches = {}   # (owner, attribute) -> original function
+_lock = threading.Lock()
+_local = threading.local()
+_state = {'atexit': False, 'own_bytes': 0}   # own_bytes: bytes read from /proc/self/io by read_bytes itself
+
+
+### FUNC ###
+
+def read_bytes():
+    """Bytes read by this process so far (rchar of /proc/self/io, 0 where it is not available), without the reads of /proc/self/io by this function"""
+    try:
+        fd = os.open('/proc/self/io', os.O_RDONLY)
+    except OSError:
+        return 0
+    try:
+        data = os.read(fd, 4096)   # a single read, counted in rchar from the next call
+    finally:
+        os.close(fd)
+    with _lock:
+        own = _state['own_bytes']
+        _state['own_bytes'] += len(data)
+    for line in data.decode().splitlines():
+        if line.startswith('rchar'):
+            return int(line.split()[1]) - own
+    return 0
+
+def timed(name, func):
+    """Wrap a function to record its wall time, calls and bytes read under the current call stack"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = getattr(_local, 'stack', ())
+        key = stack + (name,)
+        _local.stack = key
+        b0 = read_bytes()
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            dt = time.perf_counter() - t0
+            db = read_bytes() - b0
+            _local.stack = stack
+            with _lock:
+                s = _stats.setdefault(key, [0, 0., 0])
+                s[0] += 1
+                s[1] += dt
+                s[2] += db
+    return wrapper
+
+def get_targets():
+    """(owner, attribute, name) of the functions to instrument among the modules already imported: read_data, file_index and land_mask functions,
+    LACR methods and the library calls listed in LIBRARY"""
+    out = []
+    for modname in MODULES:
+        module = sys.modules.get(modname)
+        if module is None:
+            continue
+        for attr, obj in list(vars(module).items()):
+            if callable(obj) and not isinstance(obj, type) and (getattr(obj, '__module__', None) == modname) and not hasattr(obj, 'cache_clear'):
+                out.append((module, attr, modname + '.' + attr))
+    lacr = sys.modules.get('landatmospherecoupling')
+    if lacr is not None:
+        for attr, obj in list(vars(lacr.LACR).items()):
+            if callable(obj) and not attr.startswith('__'):
+                out.append((lacr.LACR, attr, 'LACR.' + attr))
+    for modname, attr in LIBRARY:
+        module = sys.modules.get(modname)
+        if (module is not None) and (attr in vars(module)):
+            out.append((module, attr, modname + '.' + attr))
+    return out
+
+def patch(owner, attr, wrapper):
+    """Replace an attribute, keeping its original to restore it"""
+    if (owner, attr) not in _patches:
+        _patches[(owner, attr)] = vars(owner)[attr]
+    setattr(owner, attr, wrapper)
+
+def enable():
+    """Instrument the targets not instrumented yet, including the names other modules imported them under (from ... import)"""
+    originals = set(id(func) for func in _patches.values())
+    for owner, attr, name in get_targets():
+        func = vars(owner)[attr]
+        if ((owner, attr) in _patches) or (id(func) in originals):
+            continue
+        wrapper = timed(name, func)
+        for module in list(sys.modules.values()):
+            if (module is not None) and (module is not owner) and (vars(module).get(attr) is func):
+                patch(module, attr, wrapper)
+        patch(owner, attr, wrapper)
+        originals.add(id(func))
+
+def disable():
+    """Restore every instrumented function"""
+    for (owner, attr), func in reversed(list(_patches.items())):
+        setattr(owner, attr, func)
+    _patches.clear()
+
+def reset():
+    """Forget the recorded calls"""
+    with _lock:
+        _stats.clear()
+
+def get_report():
+    """Per-function totals (calls, inclusive and self wall time, bytes read) and per-stack self times"""
+    with _lock:
+        stats = {key: list(s) for key, s in _stats.items()}
+    children = {}
+    for key, s in stats.items():
+        if len(key) > 1:
+            children[key[:-1]] = children.get(key[:-1], 0.) + s[1]
+    stacks = {key: max(s[1] - children.get(key, 0.), 0.) for key, s in stats.items()}
+    functions = {}
+    for key, s in stats.items():
+        f = functions.setdefault(key[-1], {'calls': 0, 'seconds': 0., 'self_seconds': 0., 'bytes': 0})
+        f['calls'] += s[0]
+        f['self_seconds'] += stacks[key]
+        if key[-1] not in key[:-1]:   # recursive calls are already included in the outer call
+            f['seconds'] += s[1]
+            f['bytes'] += s[2]
+    functions = dict(sorted(functions.items(), key=lambda item: -item[1]['self_seconds']))
+    out = {'pid': os.getpid(), 'argv': sys.argv, 'functions': functions, 'stacks': stacks}
+    return out
+
+def get_worker_files(prefix='upscale_profile'):
+    """Get the JSON reports written by the worker processes of a run (<prefix>.<pid>.json)"""
+    out = [f for f in sorted(glob.glob(prefix + '.*.json')) if f[len(prefix)+1:-len('.json')].isdigit()]
+    return out
+
+def merge_worker_reports(report, prefix='upscale_profile'):
+    """Add the per-function totals and stacks of the worker reports of a run to a report, in place"""
+    functions = report['functions']
+    stacks = report['stacks']
+    report['workers'] = []
+    for jsonfile in get_worker_files(prefix):
+        with open(jsonfile) as f:
+            worker = json.load(f)
+        report['workers'].append(worker['pid'])
+        for name, w in worker['functions'].items():
+            f = functions.setdefault(name, {'calls': 0, 'seconds': 0., 'self_seconds': 0., 'bytes': 0})
+            for k in f:
+                f[k] += w[k]
+        with open(jsonfile[:-len('.json')] + '.collapsed') as f:
+            for line in f:
+                key, micros = line.rsplit(' ', 1)
+                key = tuple(key.split(';'))
+                stacks[key] = stacks.get(key, 0.) + int(micros)*1e-6
+    report['functions'] = dict(sorted(functions.items(), key=lambda item: -item[1]['self_seconds']))
+    return report
+
+def write_report(prefix='upscale_profile', workers=False):
+    """Write the report as <prefix>.json and as collapsed stacks (<prefix>.collapsed, self time in microseconds, for flamegraph.pl or speedscope),
+    with the reports of the worker processes of the run if workers"""
+    report = get_report()
+    if workers:
+        merge_worker_reports(report, prefix)
+    stacks = report.pop('stacks')
+    jsonfile = prefix + '.json'
+    collapsedfile = prefix + '.collapsed'
+    with open(jsonfile, 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(collapsedfile, 'w') as f:
+        for key, seconds in sorted(stacks.items()):
+            f.write('%s %i\n'%(';'.join(key), round(seconds*1e6)))
+    out = [jsonfile, collapsedfile]
+    return out
+
+@contextlib.contextmanager
+def profile(prefix=None):
+    """Profile a block of code, and write its report if a prefix is given"""
+    reset()
+    enable()
+    try:
+        yield _stats
+    finally:
+        disable()
+        if prefix is not None:
+            write_report(prefix)
+
+def init_worker_report(prefix='upscale_profile'):
+    """In a worker process: forget the calls inherited from the parent process and write the report of the worker (<prefix>.<pid>) when it exits
+    (multiprocessing workers do not run atexit handlers)"""
+    reset()
+    _local.stack = ()
+    _state['own_bytes'] = 0   # the I/O counters of a new process start at 0
+    multiprocessing.util.Finalize(None, write_report, args=(prefix + '.' + str(os.getpid()),), exitpriority=10)
+
+def enable_from_env():
+    """Enable profiling for the whole run if UPSCALE_PROFILE is set: the main process writes its report at exit, merged with those of its worker processes"""
+    value = os.environ.get(ENVVAR, '')
+    if value in ['', '0']:
+        return
+    enable()
+    if not _state['atexit']:
+        prefix = 'upscale_profile' if value.lower() in ['1', 'true', 'yes'] else value
+        if multiprocessing.parent_process() is not None:   # worker started by spawn or forkserver
+            init_worker_report(prefix)
+        else:
+            for jsonfile in get_worker_files(prefix):   # reports of the workers of a previous run
+                for f in [jsonfile, jsonfile[:-len('.json')] + '.collapsed']:
+                    if os.path.isfile(f):
+                        os.remove(f)
+            atexit.register(write_report, prefix, True)
+            multiprocessing.util.register_after_fork(_local, lambda obj: init_worker_report(prefix))   # forked workers
+        _state['atexit'] = True
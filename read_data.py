@@ -2,13 +2,52 @@
 
 import sys
 import os
+import shutil
+import argparse
+import functools
+import pandas as pd
 import xarray as xr
 
 from config import KSCALEDATA, KSCALEOUTDIR
+from file_index import get_datafile
+from land_mask import get_land_mask
+from land_points import to_points, to_grid, sel_points
+from p_config import regions
+
+
+### CST ###
+
+_windows = {}   # (grid size and ends, lat_range, lon_range) -> (latitude slice, longitude slice)
 
 
 ### FUNC ###
 
+def get_index_window(lats, lons, lat_range=(-90., 90.), lon_range=(-180., 180.)):
+    """Integer index slices of lat/lon bounds on a grid (same selection as .sel with label slices), computed once per grid and region"""
+    key = (len(lats), float(lats[0]), float(lats[-1]), len(lons), float(lons[0]), float(lons[-1]), tuple(lat_range), tuple(lon_range))   # cheap: the files of a domain share a regular grid
+    if key not in _windows:
+        ilat = pd.Index(lats).slice_indexer(lat_range[0], lat_range[1])
+        ilon = pd.Index(lons).slice_indexer(lon_range[0], lon_range[1])
+        _windows[key] = (ilat, ilon)
+    out = _windows[key]
+    return out
+
+def subset_region(da, lat_range=(-90., 90.), lon_range=(-180., 180.)):
+    """Subset a field to lat/lon bounds by integer index windows, so that lazily opened files only read (and later masks only touch) this hyperslab"""
+    ilat, ilon = get_index_window(da.latitude.values, da.longitude.values, lat_range, lon_range)
+    out = da.isel(latitude=ilat, longitude=ilon)
+    return out
+
+def mask_land(da, domain='lam', resolution='km2p2', land_only=True):
+    """Mask the ocean points of a field with the cached land mask of its grid (set to NaN, the grid is kept),
+    or drop them if land_only='points' (land columns along a point dimension, see land_points.py)"""
+    mask = get_land_mask(da.latitude.values, da.longitude.values, domain, resolution)
+    if land_only == 'points':
+        out = to_points(da, mask)
+    else:
+        out = da.where(xr.DataArray(mask, dims=('latitude', 'longitude')))
+    return out
+
 def get_path_season(season='summer'):
     if season == 'summer':
         out = KSCALEDATA + '/outdir_20160801T0000Z'
@@ -21,6 +60,7 @@ def get_path_driving(season='summer', driving='RAL3'):
     out = path + '/DMn1280' + driving
     return out
 
+@functools.lru_cache(maxsize=None)
 def get_path_global(season='summer', driving='RAL3', resolution='n1280', physics='RAL3'):
     path = get_path_driving(season, driving)
     out = path + '/global_' + resolution + '_' + physics
@@ -29,6 +69,7 @@ def get_path_global(season='summer', driving='RAL3', resolution='n1280', physics
     assert os.path.isdir(out)
     return out
 
+@functools.lru_cache(maxsize=None)
 def get_path_channel(season='summer', driving='RAL3', resolution='n2560', physics='RAL3'):
     path = get_path_driving(season, driving)
     out = path + '/channel_' + resolution + '_' + physics
@@ -37,6 +78,7 @@ def get_path_channel(season='summer', driving='RAL3', resolution='n2560', physic
     assert os.path.isdir(out)
     return out
 
+@functools.lru_cache(maxsize=None)
 def get_path_lam(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3'):
     path = get_path_driving(season, driving)
     out = path + '/lam_' + region + '_' + resolution + '_' + physics
@@ -110,33 +152,35 @@ def get_varfiles_lam_profile(season='summer', driving='RAL3', region='africa', r
 
 def load_ds_var_global_single(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', variable='shfx', year=2016, month=8, day=1):
     path = get_path_global(season, driving, resolution, physics)
-    files = get_varfiles_global_single(season, driving, resolution, physics, variable)
     date = str(year) + str(month).zfill(2) + str(day).zfill(2)
-    f = [f for f in files if date in f][0]
-    datafile = path + '/single_' + variable + '/' + f
+    datafile = get_datafile(path + '/single_' + variable, date)
     out = xr.open_dataset(datafile)
     return out
 
-def load_data_global_precip(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.)):
+def load_data_global_precip(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), land_only=False):
     path = get_path_global(season, driving, resolution, physics)
-    files = get_varfiles_global_precip(season, driving, resolution, physics)
     date = str(year) + str(month).zfill(2) + str(day).zfill(2)
-    f = [f for f in files if date in f][0]
-    datafile = path + '/precip/' + f
+    datafile = get_datafile(path + '/precip', date)
     ds = xr.open_dataset(datafile)
-    out = ds.precipitation_rate.sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+    out = subset_region(ds.precipitation_rate, lat_range, lon_range)
+    if land_only:
+        out = mask_land(out, 'global', resolution, land_only)
     return out
 
-def load_data_global_smc(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+def load_data_global_smc(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0, land_only=False):
     ds = load_ds_var_global_single(season, driving, resolution, physics, 'smc', year, month, day)
-    out = ds.moisture_content_of_soil_layer.isel(depth=depth).sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+    out = subset_region(ds.moisture_content_of_soil_layer.isel(depth=depth), lat_range, lon_range)
     out = out.where(abs(out) < 1000)   # remove inf
+    if land_only:
+        out = mask_land(out, 'global', resolution, land_only)
     return out
 
-def load_data_global_single_var(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', variable='shfx', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.)):
+def load_data_global_single_var(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', variable='shfx', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), land_only=False):
     ds = load_ds_var_global_single(season, driving, resolution, physics, variable, year, month, day)
     varname = list(ds.variables)[0]
-    out = ds[varname].sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+    out = subset_region(ds[varname], lat_range, lon_range)
+    if land_only:
+        out = mask_land(out, 'global', resolution, land_only)
     return out
 
 
@@ -144,33 +188,35 @@ def load_data_global_single_var(season='summer', driving='RAL3', resolution='km2
 
 def load_ds_var_channel_single(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', variable='shfx', year=2016, month=8, day=1):
     path = get_path_channel(season, driving, resolution, physics)
-    files = get_varfiles_channel_single(season, driving, resolution, physics, variable)
     date = str(year) + str(month).zfill(2) + str(day).zfill(2)
-    f = [f for f in files if date in f][0]
-    datafile = path + '/single_' + variable + '/' + f
+    datafile = get_datafile(path + '/single_' + variable, date)
     out = xr.open_dataset(datafile)
     return out
 
-def load_data_channel_precip(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.)):
+def load_data_channel_precip(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), land_only=False):
     path = get_path_channel(season, driving, resolution, physics)
-    files = get_varfiles_channel_precip(season, driving, resolution, physics)
     date = str(year) + str(month).zfill(2) + str(day).zfill(2)
-    f = [f for f in files if date in f][0]
-    datafile = path + '/precip/' + f
+    datafile = get_datafile(path + '/precip', date)
     ds = xr.open_dataset(datafile)
-    out = ds.precipitation_rate.sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+    out = subset_region(ds.precipitation_rate, lat_range, lon_range)
+    if land_only:
+        out = mask_land(out, 'channel', resolution, land_only)
     return out
 
-def load_data_channel_smc(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+def load_data_channel_smc(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0, land_only=False):
     ds = load_ds_var_channel_single(season, driving, resolution, physics, 'smc', year, month, day)
-    out = ds.moisture_content_of_soil_layer.isel(depth=depth).sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+    out = subset_region(ds.moisture_content_of_soil_layer.isel(depth=depth), lat_range, lon_range)
     out = out.where(abs(out) < 1000)   # remove inf
+    if land_only:
+        out = mask_land(out, 'channel', resolution, land_only)
     return out
 
-def load_data_channel_single_var(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', variable='shfx', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.)):
+def load_data_channel_single_var(season='summer', driving='RAL3', resolution='km2p2', physics='RAL3', variable='shfx', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), land_only=False):
     ds = load_ds_var_channel_single(season, driving, resolution, physics, variable, year, month, day)
     varname = list(ds.variables)[0]
-    out = ds[varname].sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+    out = subset_region(ds[varname], lat_range, lon_range)
+    if land_only:
+        out = mask_land(out, 'channel', resolution, land_only)
     return out
 
 
@@ -178,35 +224,153 @@ def load_data_channel_single_var(season='summer', driving='RAL3', resolution='km
 
 def load_ds_var_lam_single(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='shfx', year=2016, month=8, day=1):
     path = get_path_lam(season, driving, region, resolution, physics)
-    files = get_varfiles_lam_single(season, driving, region, resolution, physics, variable)
     date = str(year) + str(month).zfill(2) + str(day).zfill(2)
-    f = [f for f in files if date in f][0]
-    datafile = path + '/single_' + variable + '/' + f
+    datafile = get_datafile(path + '/single_' + variable, date)
     out = xr.open_dataset(datafile)
     return out
 
-def load_data_lam_precip(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.)):
+def load_data_lam_precip(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), land_only=False):
     path = get_path_lam(season, driving, region, resolution, physics)
-    files = get_varfiles_lam_precip(season, driving, region, resolution, physics)
     date = str(year) + str(month).zfill(2) + str(day).zfill(2)
-    f = [f for f in files if date in f][0]
-    datafile = path + '/precip/' + f
+    datafile = get_datafile(path + '/precip', date)
     ds = xr.open_dataset(datafile)
-    out = ds.precipitation_rate.sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+    out = subset_region(ds.precipitation_rate, lat_range, lon_range)
+    if land_only:
+        out = mask_land(out, 'lam', resolution, land_only)
     return out
 
-def load_data_lam_smc(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+def load_data_lam_smc(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0, land_only=False):
     ds = load_ds_var_lam_single(season, driving, region, resolution, physics, 'smc', year, month, day)
-    out = ds.moisture_content_of_soil_layer.isel(depth=depth).sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+    out = subset_region(ds.moisture_content_of_soil_layer.isel(depth=depth), lat_range, lon_range)
     out = out.where(abs(out) < 1000)   # remove inf
+    if land_only:
+        out = mask_land(out, 'lam', resolution, land_only)
     return out
 
-def load_data_lam_single_var(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='shfx', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.)):
+def load_data_lam_single_var(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='shfx', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), land_only=False):
     ds = load_ds_var_lam_single(season, driving, region, resolution, physics, variable, year, month, day)
     varname = list(ds.variables)[0]
-    out = ds[varname].sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+    out = subset_region(ds[varname], lat_range, lon_range)
+    if land_only:
+        out = mask_land(out, 'lam', resolution, land_only)
+    return out
+
+
+
+#~~~ MULTI-DAY ~~~#
+
+def get_path_domain(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3'):
+    if domain == 'global':
+        out = get_path_global(season, driving, resolution, physics)
+    elif domain == 'channel':
+        out = get_path_channel(season, driving, resolution, physics)
+    elif domain == 'lam':
+        out = get_path_lam(season, driving, region, resolution, physics)
     return out
 
+def load_data_domain(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='shfx', year=2016, month=8, day=1, lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0, land_only=False):
+    """Load a variable of one day of any domain (variable='precip' for precipitation, 'smc' for soil moisture; land_only=True masks the ocean, 'points' drops it)"""
+    if domain == 'global':
+        if variable == 'precip':
+            out = load_data_global_precip(season, driving, resolution, physics, year, month, day, lat_range, lon_range, land_only)
+        elif variable == 'smc':
+            out = load_data_global_smc(season, driving, resolution, physics, year, month, day, lat_range, lon_range, depth, land_only)
+        else:
+            out = load_data_global_single_var(season, driving, resolution, physics, variable, year, month, day, lat_range, lon_range, land_only)
+    elif domain == 'channel':
+        if variable == 'precip':
+            out = load_data_channel_precip(season, driving, resolution, physics, year, month, day, lat_range, lon_range, land_only)
+        elif variable == 'smc':
+            out = load_data_channel_smc(season, driving, resolution, physics, year, month, day, lat_range, lon_range, depth, land_only)
+        else:
+            out = load_data_channel_single_var(season, driving, resolution, physics, variable, year, month, day, lat_range, lon_range, land_only)
+    elif domain == 'lam':
+        if variable == 'precip':
+            out = load_data_lam_precip(season, driving, region, resolution, physics, year, month, day, lat_range, lon_range, land_only)
+        elif variable == 'smc':
+            out = load_data_lam_smc(season, driving, region, resolution, physics, year, month, day, lat_range, lon_range, depth, land_only)
+        else:
+            out = load_data_lam_single_var(season, driving, region, resolution, physics, variable, year, month, day, lat_range, lon_range, land_only)
+    return out
+
+def get_varpath_domain(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='shfx'):
+    path = get_path_domain(domain, season, driving, region, resolution, physics)
+    if variable == 'precip':
+        out = path + '/precip'
+    else:
+        out = path + '/single_' + variable
+    return out
+
+def get_file_dates(start, end):
+    """Dates of the daily files holding the time steps of the days between two dates (included), with the files of the days before and after
+    for the time steps spilling over midnight"""
+    out = pd.date_range(pd.Timestamp(start) - pd.Timedelta('1D'), pd.Timestamp(end) + pd.Timedelta('1D'), freq='1D')
+    return out
+
+def get_datafiles_range(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='shfx', start='2016-08-01', end='2016-08-31', neighbours=False):
+    """Get the daily files of a variable between two dates (included), and those of the days before and after if neighbours (where they exist)"""
+    varpath = get_varpath_domain(domain, season, driving, region, resolution, physics, variable)
+    dates = get_file_dates(start, end) if neighbours else pd.date_range(start, end, freq='1D')
+    out = []
+    for date in dates:
+        try:
+            out.append(get_datafile(varpath, date.strftime('%Y%m%d')))
+        except KeyError:   # no file before the first day of the run or after the last day available
+            if (not neighbours) or (date in dates[1:-1]):
+                raise
+    return out
+
+def sel_days(da, start='2016-08-01', end='2016-08-31'):
+    """Select the time steps of the days between two dates (included)"""
+    out = da.sel(time=slice(pd.Timestamp(start), pd.Timestamp(end) + pd.Timedelta('1D') - pd.Timedelta('1ns')))
+    return out
+
+def subset_var(ds, variable='shfx', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    """Select a variable and a lat/lon subset of a daily dataset (depth=None keeps every soil layer)"""
+    if variable == 'precip':
+        varname = 'precipitation_rate'
+    elif variable == 'smc':
+        varname = 'moisture_content_of_soil_layer'
+    else:
+        varname = list(ds.variables)[0]
+    out = ds[varname]
+    if (variable == 'smc') and (depth is not None):
+        out = out.isel(depth=depth)
+    out = subset_region(out, lat_range, lon_range)
+    out = out.to_dataset()
+    return out
+
+def open_data_range_files(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='shfx', start='2016-08-01', end='2016-08-31', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0, chunks={}):
+    """Lazily open the time steps of a variable over a range of days, from their daily files and those of the days before and after (time steps spilling over midnight)"""
+    files = get_datafiles_range(domain, season, driving, region, resolution, physics, variable, start, end, neighbours=True)
+    preprocess = functools.partial(subset_var, variable=variable, lat_range=lat_range, lon_range=lon_range, depth=depth)
+    ds = xr.open_mfdataset(files, combine='nested', concat_dim='time', preprocess=preprocess, chunks=chunks,
+                           data_vars='minimal', coords='minimal', compat='override')
+    out = sel_days(ds[list(ds.data_vars)[0]], start, end)
+    return out
+
+def open_data_range_zarr(store, variable='shfx', start='2016-08-01', end='2016-08-31', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    """Lazily open a variable over a range of days from its rechunked Zarr store"""
+    ds = xr.open_zarr(store)
+    out = ds[list(ds.data_vars)[0]]
+    out = sel_days(out, start, end)
+    if (variable == 'smc') and (depth is not None):
+        out = out.isel(depth=depth)
+    out = subset_region(out, lat_range, lon_range)
+    return out
+
+def load_data_range(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='shfx', start='2016-08-01', end='2016-08-31', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0, chunks={}, land_only=False):
+    """Lazily open a variable over a range of days as a single dask-backed DataArray (variable='precip' for precipitation, 'smc' for soil moisture), from its Zarr store if it holds the whole request"""
+    store = get_zarr_store(season, driving, domain, resolution, physics, variable)
+    if store_covers(store, lat_range, lon_range, start, end, region if domain == 'lam' else None):
+        out = open_data_range_zarr(store, variable, start, end, lat_range, lon_range, depth)
+    else:
+        out = open_data_range_files(domain, season, driving, region, resolution, physics, variable, start, end, lat_range, lon_range, depth, chunks)
+    if variable == 'smc':
+        out = out.where(abs(out) < 1000)   # remove inf
+    if land_only:
+        out = mask_land(out, domain, resolution, land_only)
+    return out
 
 
 ############################
@@ -222,28 +386,253 @@ def get_var_path_season(season='summer'):
         out = KSCALEOUTDIR + '/outdir_20200120T0000Z'
     return out
 
-def load_var_global(season='summer', driving='RAL3', resolution='n1280', physics='RAL3', variable='ef', lat_range=(-90., 90.), lon_range=(-180., 180.)):
+def get_var_path(season='summer', driving='RAL3', domain='global', resolution='n1280', physics='RAL3', variable='ef'):
     datapath = get_var_path_season(season)
-    datapath = datapath + '/' + variable + '/DMn1280' + driving + '/global_' + resolution + '_' + physics
+    out = datapath + '/' + variable + '/DMn1280' + driving + '/' + domain + '_' + resolution + '_' + physics
+    return out
+
+def open_var_daily(datapath, variable='ef', lat_range=(-90., 90.), lon_range=(-180., 180.), points=False, store=None, level=1, region=None):
+    """Open a daily output from its Zarr store (if it holds the region and is up to date), stored on the grid (<variable>_daily.nc) or as land points (<variable>_daily_land.nc), as a grid or as points; level > 1 opens its coarse-grained copy (<variable>_daily_x<level>.nc)"""
     datafile = datapath + '/' + variable + '_daily.nc'
-    da = xr.open_dataarray(datafile)
-    out = da.sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+    landfile = datapath + '/' + variable + '_daily_land.nc'
+    dailyfile = datafile if os.path.isfile(datafile) else landfile
+    if level > 1:
+        da = xr.open_dataarray(datapath + '/' + variable + '_daily_x' + str(level) + '.nc')
+        out = subset_region(da, lat_range, lon_range)
+        if points:
+            out = to_points(out)
+    elif (store is not None) and store_covers(store, lat_range, lon_range, region=region) and \
+         ((not os.path.isfile(dailyfile)) or (os.path.getmtime(store) >= os.path.getmtime(dailyfile))):   # not older than the daily file, if any
+        ds = xr.open_zarr(store)
+        out = subset_region(ds[list(ds.data_vars)[0]], lat_range, lon_range)
+        if points:
+            out = to_points(out)
+    elif os.path.isfile(datafile) or not os.path.isfile(landfile):
+        da = xr.open_dataarray(datafile)
+        out = subset_region(da, lat_range, lon_range)
+        if points:
+            out = to_points(out)
+    else:
+        da = xr.open_dataarray(landfile, chunks={})
+        out = sel_points(da, lat_range, lon_range)
+        if not points:
+            out = subset_region(to_grid(out), lat_range, lon_range)
     return out
 
+def get_zarr_store(season='summer', driving='RAL3', domain='global', resolution='n1280', physics='RAL3', variable='ef'):
+    datapath = get_var_path(season, driving, domain, resolution, physics, 'zarr')
+    out = datapath + '/' + variable + '.zarr'
+    return out
 
-def load_var_channel(season='summer', driving='RAL3', resolution='n2560', physics='RAL3', variable='ef', lat_range=(-90., 90.), lon_range=(-180., 180.)):
-    datapath = get_var_path_season(season)
-    datapath = datapath + '/' + variable + '/DMn1280' + driving + '/channel_' + resolution + '_' + physics
-    datafile = datapath + '/' + variable  + '_daily.nc'
-    da = xr.open_dataarray(datafile)
-    out = da.sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+def store_covers(store, lat_range=(-90., 90.), lon_range=(-180., 180.), start=None, end=None, region=None):
+    """Whether a Zarr store holds a whole request: lat/lon bounds, days and LAM region it was built with (attrs written by rechunk_to_zarr)"""
+    if not os.path.isdir(store):
+        return False
+    attrs = xr.open_zarr(store).attrs
+    if ('lat_range' not in attrs) or (attrs.get('days') != 'complete'):   # store written without its coverage, or without the time steps of its first and last days held in the neighbouring files
+        return False
+    out = (attrs['lat_range'][0] <= lat_range[0]) and (attrs['lat_range'][1] >= lat_range[1]) and \
+          (attrs['lon_range'][0] <= lon_range[0]) and (attrs['lon_range'][1] >= lon_range[1])
+    if start is not None:
+        out = out and (pd.Timestamp(attrs['start']) <= pd.Timestamp(start))
+    if end is not None:
+        out = out and (pd.Timestamp(attrs['end']) >= pd.Timestamp(end))
+    if region is not None:
+        out = out and (attrs['region'] == region)
     return out
 
+def load_var_global(season='summer', driving='RAL3', resolution='n1280', physics='RAL3', variable='ef', lat_range=(-90., 90.), lon_range=(-180., 180.), land_only=False, points=False, level=1):
+    datapath = get_var_path(season, driving, 'global', resolution, physics, variable)
+    store = get_zarr_store(season, driving, 'global', resolution, physics, variable)
+    out = open_var_daily(datapath, variable, lat_range, lon_range, points, store, level)
+    if land_only and not points and (level == 1):   # coarse levels are land-weighted means already
+        out = mask_land(out, 'global', resolution, land_only)
+    return out
 
-def load_var_lam(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='ef', lat_range=(-90., 90.), lon_range=(-180., 180.)):
-    datapath = get_var_path_season(season)
-    datapath = datapath + '/' + variable  + '/DMn1280' + driving + '/lam_' + resolution + '_' + physics
-    datafile = datapath + '/' + variable + '_daily.nc'
-    da = xr.open_dataarray(datafile)
-    out = da.sel(latitude=slice(lat_range[0], lat_range[1]), longitude=slice(lon_range[0], lon_range[1]))
+
+def load_var_channel(season='summer', driving='RAL3', resolution='n2560', physics='RAL3', variable='ef', lat_range=(-90., 90.), lon_range=(-180., 180.), land_only=False, points=False, level=1):
+    datapath = get_var_path(season, driving, 'channel', resolution, physics, variable)
+    store = get_zarr_store(season, driving, 'channel', resolution, physics, variable)
+    out = open_var_daily(datapath, variable, lat_range, lon_range, points, store, level)
+    if land_only and not points and (level == 1):   # coarse levels are land-weighted means already
+        out = mask_land(out, 'channel', resolution, land_only)
+    return out
+
+
+def load_var_lam(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='ef', lat_range=(-90., 90.), lon_range=(-180., 180.), land_only=False, points=False, level=1):
+    datapath = get_var_path(season, driving, 'lam', resolution, physics, variable)
+    store = get_zarr_store(season, driving, 'lam', resolution, physics, variable)
+    out = open_var_daily(datapath, variable, lat_range, lon_range, points, store, level, region)
+    if land_only and not points and (level == 1):   # coarse levels are land-weighted means already
+        out = mask_land(out, 'lam', resolution, land_only)
+    return out
+
+
+def load_var_domain(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variable='ef', lat_range=(-90., 90.), lon_range=(-180., 180.), land_only=False, points=False, level=1):
+    """Load a daily output of any domain"""
+    if domain == 'global':
+        out = load_var_global(season, driving, resolution, physics, variable, lat_range, lon_range, land_only, points, level)
+    elif domain == 'channel':
+        out = load_var_channel(season, driving, resolution, physics, variable, lat_range, lon_range, land_only, points, level)
+    elif domain == 'lam':
+        out = load_var_lam(season, driving, region, resolution, physics, variable, lat_range, lon_range, land_only, points, level)
+    return out
+
+
+
+############################
+#                          #
+#   LOAD SM-EF MODELS      #
+#                          #
+############################
+
+def get_sm_ef_models_file(season='summer', driving='RAL3', domain='global', resolution='n1280', physics='RAL3', depth=0, level=1):
+    datapath = get_var_path(season, driving, domain, resolution, physics, 'sm_ef_models')
+    out = datapath + '/sm_ef_models_depth=' + str(depth)
+    if level > 1:
+        out = out + '_x' + str(level)
+    out = out + '.nc'
+    return out
+
+def load_sm_ef_models(season='summer', driving='RAL3', domain='global', resolution='n1280', physics='RAL3', variable='number', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0, level=1):
+    datafile = get_sm_ef_models_file(season, driving, domain, resolution, physics, depth, level)
+    ds = xr.open_dataset(datafile)
+    out = subset_region(ds[variable], lat_range, lon_range)
+    return out
+
+#~~~ GLOBAL ~~~#
+
+def load_sm_ef_model_number_glo(season='summer', driving='RAL3', resolution='n1280', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'global', resolution, physics, 'number', lat_range, lon_range, depth)
+    return out
+
+def load_wilting_point_glo(season='summer', driving='RAL3', resolution='n1280', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'global', resolution, physics, 'wilt', lat_range, lon_range, depth)
+    return out
+
+def load_critical_point_glo(season='summer', driving='RAL3', resolution='n1280', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'global', resolution, physics, 'crit', lat_range, lon_range, depth)
+    return out
+
+def load_slope_glo(season='summer', driving='RAL3', resolution='n1280', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'global', resolution, physics, 'slope', lat_range, lon_range, depth)
+    return out
+
+def load_time_glo(season='summer', driving='RAL3', resolution='n1280', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'global', resolution, physics, 'time_frac', lat_range, lon_range, depth)
     return out
+
+#~~~ CHANNEL ~~~#
+
+def load_sm_ef_model_number_channel(season='summer', driving='RAL3', resolution='n2560', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'channel', resolution, physics, 'number', lat_range, lon_range, depth)
+    return out
+
+def load_wilting_point_channel(season='summer', driving='RAL3', resolution='n2560', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'channel', resolution, physics, 'wilt', lat_range, lon_range, depth)
+    return out
+
+def load_critical_point_channel(season='summer', driving='RAL3', resolution='n2560', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'channel', resolution, physics, 'crit', lat_range, lon_range, depth)
+    return out
+
+def load_slope_channel(season='summer', driving='RAL3', resolution='n2560', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'channel', resolution, physics, 'slope', lat_range, lon_range, depth)
+    return out
+
+def load_time_channel(season='summer', driving='RAL3', resolution='n2560', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'channel', resolution, physics, 'time_frac', lat_range, lon_range, depth)
+    return out
+
+#~~~ LAM ~~~#
+
+def load_sm_ef_model_number_lam(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'lam', resolution, physics, 'number', lat_range, lon_range, depth)
+    return out
+
+def load_wilting_point_lam(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'lam', resolution, physics, 'wilt', lat_range, lon_range, depth)
+    return out
+
+def load_critical_point_lam(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'lam', resolution, physics, 'crit', lat_range, lon_range, depth)
+    return out
+
+def load_slope_lam(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'lam', resolution, physics, 'slope', lat_range, lon_range, depth)
+    return out
+
+def load_time_lam(season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', lat_range=(-90., 90.), lon_range=(-180., 180.), depth=0):
+    out = load_sm_ef_models(season, driving, 'lam', resolution, physics, 'time_frac', lat_range, lon_range, depth)
+    return out
+
+
+
+############################
+#                          #
+#     REBUILD AS ZARR      #
+#                          #
+############################
+
+def rechunk_to_zarr(domain='lam', season='summer', driving='RAL3', region='africa', resolution='km2p2', physics='RAL3', variables=['smc', 'precip', 'lhfx', 'shfx', 'ef'],
+                    start='2016-08-01', end='2016-08-31', lat_range=(-90., 90.), lon_range=(-180., 180.), chunk_size=64):
+    """Convert the daily files of a season into one Zarr store per variable chunked along space with the full time series in each chunk"""
+    out = []
+    for variable in variables:
+        print(variable, end=' : ', flush=True)
+        if variable == 'ef':
+            datapath = get_var_path(season, driving, domain, resolution, physics, variable)
+            da = open_var_daily(datapath, variable, lat_range, lon_range)
+        else:
+            da = open_data_range_files(domain, season, driving, region, resolution, physics, variable, start, end, lat_range, lon_range, depth=None)
+        chunks = {'time': -1, 'latitude': chunk_size, 'longitude': chunk_size}
+        if 'depth' in da.dims:
+            chunks['depth'] = 1
+        ds = da.chunk(chunks).to_dataset()
+        for var in ds.variables:
+            ds[var].encoding = {}
+        days = pd.DatetimeIndex(ds.time.values).floor('D')   # complete days: open_data_range_files reads the neighbouring files too
+        ds.attrs = {'region': region, 'lat_range': list(lat_range), 'lon_range': list(lon_range),   # coverage checked by store_covers
+                    'start': days[0].strftime('%Y-%m-%d'), 'end': days[-1].strftime('%Y-%m-%d'), 'days': 'complete'}
+        store = get_zarr_store(season, driving, domain, resolution, physics, variable)
+        os.makedirs(os.path.dirname(store), exist_ok=True)
+        tmpstore = store + '.tmp'
+        if os.path.isdir(tmpstore):
+            shutil.rmtree(tmpstore)
+        ds.to_zarr(tmpstore, mode='w')
+        if os.path.isdir(store):
+            shutil.rmtree(store)
+        os.replace(tmpstore, store)
+        out.append(store)
+    return out
+
+
+### PROFILING ###
+
+if os.environ.get('UPSCALE_PROFILE'):   # opt-in instrumentation, see profiling.py
+    import profiling
+    profiling.enable_from_env()
+
+
+### MAIN ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rechunk the daily files of a season into Zarr stores for per-gridpoint access')
+    parser.add_argument('--season', type=str, default='winter')
+    parser.add_argument('--driving', type=str, default='GAL9')
+    parser.add_argument('--domain', type=str, default='lam', choices=['global', 'channel', 'lam'])
+    parser.add_argument('--region', type=str, default='africa')
+    parser.add_argument('--resolution', type=str, default='km2p2')
+    parser.add_argument('--physics', type=str, default='RAL3')
+    parser.add_argument('--variables', type=str, nargs='+', default=['smc', 'precip', 'lhfx', 'shfx', 'ef'])
+    parser.add_argument('--start', type=str, default='2020-01-20')
+    parser.add_argument('--end', type=str, default='2020-02-28')
+    parser.add_argument('--chunk_size', type=int, default=64)
+    args = parser.parse_args()
+
+    lat_range = regions[args.region][0]
+    lon_range = regions[args.region][1]
+
+    stores = rechunk_to_zarr(args.domain, args.season, args.driving, args.region, args.resolution, args.physics, args.variables,
+                             args.start, args.end, lat_range, lon_range, args.chunk_size)
+    print('\nSaved: %s'%', '.join(stores))
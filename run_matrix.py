@@ -0,0 +1,191 @@
+"""Run the EF, SM and precipitation series, precipitation statistics and regime maps of a season x driving x region matrix as one dependency graph"""
+
+import sys
+import os
+import argparse
+import itertools
+import contextlib
+import traceback
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import read_data
+
+from config import KSCALEOUTDIR
+from read_data import get_sm_ef_models_file
+from write_data import make_dir, write_netcdf
+from daily_stats import get_daily_file, get_processed_days, update_daily
+from compute_sm_ef_models import load_daily_sm, load_daily_ef, compute_sm_ef_models
+from precip_stats import get_precip_stats_file, compute_precip_stats
+from compare_domains import DOMAINS, get_domains
+from p_config import regions, experiments, periods
+
+
+### CST ###
+
+STEPS = ['ef', 'smc', 'precip', 'regimes', 'precip_stats']
+
+DEPENDENCIES = {'regimes': ['ef']}   # step -> steps of the same configuration and domain it reads
+
+
+### FUNC ###
+
+def set_region_outdir(region):
+    """Write the outputs of a region under <KSCALEOUTDIR>/<region>: the files of the global and channel runs do not depend on the region otherwise"""
+    read_data.KSCALEOUTDIR = KSCALEOUTDIR + '/' + region
+    out = read_data.KSCALEOUTDIR
+    return out
+
+def run_daily(domain, season, driving, region, resolution, physics, variable, start, end, depth=0):
+    """Task: append the missing days of the daily series of a variable and update its statistics"""
+    set_region_outdir(region)
+    lat_range = regions[region][0]
+    lon_range = regions[region][1]
+    out = update_daily(domain, season, driving, region, resolution, physics, variable, start, end, lat_range, lon_range, depth)
+    return out
+
+def run_regimes(domain, season, driving, region, resolution, physics, start, end, depth=0, min_days=10, nworkers=1):
+    """Task: fit the SM-EF regimes of a domain from its daily EF series"""
+    set_region_outdir(region)
+    lat_range = regions[region][0]
+    lon_range = regions[region][1]
+    sm = load_daily_sm(domain, season, driving, region, resolution, physics, start, end, lat_range, lon_range, depth)
+    ef = load_daily_ef(domain, season, driving, region, resolution, physics, lat_range, lon_range)
+    outfile = get_sm_ef_models_file(season, driving, domain, resolution, physics, depth)
+    tiledir = make_dir(os.path.dirname(outfile)) + '/tiles_depth=' + str(depth)   # tiles of an interrupted fit are kept if its inputs and settings did not change
+    out = compute_sm_ef_models(sm, ef, tiledir, outfile, nworkers=nworkers, min_days=min_days)
+    return out
+
+def run_precip_stats(season, driving, region, start, end):
+    """Task: precipitation statistics of all domains over a region"""
+    set_region_outdir(region)
+    ds = compute_precip_stats(season, driving, region, start, end)
+    outfile = get_precip_stats_file(season, driving, region, start, end)
+    make_dir(os.path.dirname(outfile))
+    out = write_netcdf(ds, outfile)
+    return out
+
+def run_task(func, args, logfile):
+    """Run a task with its output and warnings redirected to a log file"""
+    make_dir(os.path.dirname(logfile))
+    with open(logfile, 'w') as f, contextlib.redirect_stdout(f), contextlib.redirect_stderr(f):
+        try:
+            out = func(*args)
+        except Exception:
+            traceback.print_exc(file=f)
+            raise
+    return out
+
+def get_tasks(seasons, drivings, region_names, steps=STEPS, domains=DOMAINS, depth=0, min_days=10, fit_workers=1):
+    """Tasks of a matrix: name -> function, arguments, output file, days it must hold (daily series), dependencies and log file"""
+    tasks = {}
+    for season, driving, region in itertools.product(seasons, drivings, region_names):
+        start, end = periods[season]
+        days = pd.date_range(start, end, freq='1D')
+        outdir = set_region_outdir(region)
+        config = '/'.join([season, driving, region])
+        for domain, (resolution, physics) in get_domains(driving, domains).items():
+            for variable in ['ef', 'smc', 'precip']:
+                tasks[variable + '/' + config + '/' + domain] = {'func': run_daily, 'args': (domain, season, driving, region, resolution, physics, variable, start, end, depth),
+                                                                 'outfile': get_daily_file(season, driving, domain, resolution, physics, variable), 'days': days}
+            tasks['regimes/' + config + '/' + domain] = {'func': run_regimes, 'args': (domain, season, driving, region, resolution, physics, start, end, depth, min_days, fit_workers),
+                                                         'outfile': get_sm_ef_models_file(season, driving, domain, resolution, physics, depth)}
+        tasks['precip_stats/' + config] = {'func': run_precip_stats, 'args': (season, driving, region, start, end),
+                                           'outfile': get_precip_stats_file(season, driving, region, start, end)}
+        for name, task in tasks.items():
+            if 'logfile' not in task:
+                step, rest = name.split('/', 1)
+                task['deps'] = [dep + '/' + rest for dep in DEPENDENCIES.get(step, [])]
+                task['logfile'] = outdir + '/logs/' + name.replace('/', '_') + '.log'
+    # keep the requested steps and the tasks they depend on
+    keep = set(name for name in tasks if name.split('/')[0] in steps)
+    todo = list(keep)
+    while len(todo) > 0:
+        for dep in tasks[todo.pop()]['deps']:
+            if dep not in keep:
+                keep.add(dep)
+                todo.append(dep)
+    out = {name: task for name, task in tasks.items() if name in keep}
+    return out
+
+def is_up_to_date(task, tasks):
+    """Whether the output of a task exists, holds all its days, and is newer than the outputs of its dependencies"""
+    outfile = task['outfile']
+    if not os.path.isfile(outfile):
+        return False
+    if ('days' in task) and not task['days'].isin(get_processed_days(outfile)).all():
+        return False
+    mtime = os.path.getmtime(outfile)
+    for dep in task['deps']:
+        depfile = tasks[dep]['outfile']
+        if (not os.path.isfile(depfile)) or (os.path.getmtime(depfile) > mtime):
+            return False
+    return True
+
+def run_tasks(tasks, nworkers=None, force=False, dry_run=False):
+    """Run a dependency graph of tasks concurrently: a task starts once its dependencies are done, tasks with up-to-date outputs are skipped
+    and the dependents of a failed task are cancelled"""
+    state = {}   # name -> 'done', 'skipped', 'failed', 'cancelled' or 'planned' (dry run)
+    pending = dict(tasks)
+    running = {}
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        while (len(pending) > 0) or (len(running) > 0):
+            for name, task in list(pending.items()):
+                deps = [state.get(dep) for dep in task['deps']]
+                if any(s in ['failed', 'cancelled'] for s in deps):
+                    state[name] = 'cancelled'
+                elif all(s in ['done', 'skipped', 'planned'] for s in deps):
+                    if (not force) and ('planned' not in deps) and is_up_to_date(task, tasks):
+                        state[name] = 'skipped'
+                    elif dry_run:
+                        state[name] = 'planned'
+                    else:
+                        running[pool.submit(run_task, task['func'], task['args'], task['logfile'])] = name
+                        print('start %s'%name, flush=True)
+                        del pending[name]
+                        continue
+                else:
+                    continue
+                print('%s %s'%(state[name], name), flush=True)
+                del pending[name]
+            if len(running) == 0:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    state[name] = 'done'
+                except Exception as e:
+                    state[name] = 'failed'
+                    print('failed %s: %s (see %s)'%(name, e, tasks[name]['logfile']), flush=True)
+                    continue
+                print('done %s'%name, flush=True)
+    out = state
+    return out
+
+
+### MAIN ###
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the EF, SM and precipitation series, precipitation statistics and regime maps of an experiment matrix (see p_config)')
+    parser.add_argument('--seasons', type=str, nargs='+', default=experiments['season'])
+    parser.add_argument('--drivings', type=str, nargs='+', default=experiments['driving'])
+    parser.add_argument('--regions', type=str, nargs='+', default=experiments['region'], choices=list(regions))
+    parser.add_argument('--steps', type=str, nargs='+', default=STEPS, choices=STEPS, help='steps to run (with the steps they depend on)')
+    parser.add_argument('--depth', type=int, default=0)
+    parser.add_argument('--min_days', type=int, default=10)
+    parser.add_argument('--nworkers', type=int, default=None, help='tasks run concurrently')
+    parser.add_argument('--fit_workers', type=int, default=1, help='processes of each regime fit')
+    parser.add_argument('--force', action='store_true', help='rerun tasks with up-to-date outputs')
+    parser.add_argument('--dry_run', action='store_true', help='only print the tasks that would run')
+    args = parser.parse_args()
+
+    tasks = get_tasks(args.seasons, args.drivings, args.regions, args.steps, DOMAINS, args.depth, args.min_days, args.fit_workers)
+    print('%i tasks'%len(tasks))
+    state = run_tasks(tasks, args.nworkers, args.force, args.dry_run)
+    counts = pd.Series(state).value_counts()
+    print(', '.join(['%s %i'%(s, n) for s, n in counts.items()]))
+    if 'failed' in counts:
+        sys.exit(1)
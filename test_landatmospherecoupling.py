@@ -0,0 +1,53 @@
+"""Compare the LACR and closed-form batch estimators of the SM-EF regimes on the same synthetic columns (python -m pytest test_landatmospherecoupling.py)"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from landatmospherecoupling import fit_regimes, batch_gufunc, REGIME_VARS
+
+
+### FUNC ###
+
+def make_columns(nlat=6, nlon=6, ntime=60, noise=0.02, increasing=False, seed=0):
+    """Daily (time, latitude, longitude) SM and EF of dry-to-transitional-to-wet columns (as benchmark.make_sm_ef), with SM increasing in time if increasing
+    (so that the np.linspace points at which both estimators evaluate the models for RSS follow the observed SM)"""
+    rng = np.random.default_rng(seed)
+    wilt = rng.uniform(10., 15., (nlat, nlon))
+    crit = rng.uniform(25., 30., (nlat, nlon))
+    sm = rng.uniform(5., 40., (ntime, nlat, nlon))
+    if increasing:
+        sm = np.sort(sm, axis=0)
+    ef = 0.1 + 0.6 * (np.clip(sm, wilt, crit) - wilt) / (crit - wilt) + rng.normal(0., noise, sm.shape)
+    coords = {'time': pd.date_range('2020-02-01', periods=ntime, freq='1D'), 'latitude': np.arange(nlat), 'longitude': np.arange(nlon)}
+    dims = ('time', 'latitude', 'longitude')
+    out = (xr.DataArray(sm, coords=coords, dims=dims), xr.DataArray(ef, coords=coords, dims=dims))
+    return out
+
+def compare_methods(sm, ef):
+    """Regime maps of both estimators: LACR (fit_regimes) and batch (batch_gufunc on the same (..., time) columns)"""
+    lacr = fit_regimes(sm, ef)
+    values = batch_gufunc(sm.transpose(..., 'time').values, ef.transpose(..., 'time').values)
+    batch = xr.Dataset({var: (('latitude', 'longitude'), values[..., k]) for k, var in enumerate(REGIME_VARS)}, coords=lacr.coords)
+    out = (lacr, batch)
+    return out
+
+
+### TESTS ###
+
+def test_same_model_random_days():
+    sm, ef = make_columns()
+    lacr, batch = compare_methods(sm, ef)
+    np.testing.assert_array_equal(lacr.number.values, batch.number.values)
+
+def test_same_model_and_parameters_increasing_sm():
+    sm, ef = make_columns(increasing=True)
+    lacr, batch = compare_methods(sm, ef)
+    same = lacr.number.values == batch.number.values
+    assert same.mean() >= 0.9
+    assert (lacr.number.values[same] >= 2).all()   # breakpoint models are selected
+    for var in ['wilt', 'crit']:
+        a = lacr[var].values[same]
+        b = batch[var].values[same]
+        np.testing.assert_array_equal(np.isnan(a), np.isnan(b))
+        np.testing.assert_allclose(b[~np.isnan(a)], a[~np.isnan(a)], rtol=0.05)
@@ -0,0 +1,144 @@
+"""Write data functions"""
+
+import sys
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+
+from land_points import to_points
+
+
+### CST ###
+
+INTVARS = {'number': 'i1', 'status': 'i1', 'nfev': 'i4'}   # integer fields stored as integers (fill value -1)
+QUANTIZATION = {'ef': (0., 1.), 'time_frac': (0., 100.)}   # bounded fields: int16 packing of a fixed range, so that daily files can be appended to
+DECIMALS = {'wilt': 2, 'crit': 2, 'slope': 4, 'wilt_lo': 2, 'wilt_hi': 2, 'crit_lo': 2, 'crit_hi': 2, 'slope_lo': 4, 'slope_hi': 4}   # unbounded fields: float32 rounded to these decimals
+
+NBITS = 16
+
+
+### FUNC ###
+
+def make_dir(path):
+    """Create a directory (and its parents) if it does not exist"""
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def write_netcdf(ds, outfile, encoding=None):
+    """Write a dataset to NetCDF through a temporary file so that an interrupted write leaves no partial output"""
+    tmpfile = outfile + '.tmp'
+    ds.to_netcdf(tmpfile, encoding=encoding)
+    os.replace(tmpfile, outfile)
+    return outfile
+
+def get_packing(vmin, vmax, nbits=NBITS):
+    """scale_factor and add_offset packing [vmin, vmax] into signed integers of nbits, the lowest integer being kept as fill value"""
+    nlevels = 2**nbits - 3
+    if vmax > vmin:
+        scale = (vmax - vmin) / nlevels
+    else:
+        scale = 1.
+    out = (np.float64(scale), np.float64((vmax + vmin) / 2.))
+    return out
+
+def get_encoding(ds, complevel=4, chunk_size=512, pack=True):
+    """NetCDF encoding of the float fields of a dataset, chunked and zlib-compressed: integers for model numbers, status codes and counters,
+    and if pack, int16 scale/offset quantization of a fixed range for bounded fields and float32 rounded to a number of decimals for the others
+    (float32 otherwise, for intermediate files packed later)"""
+    out = {}
+    for var in ds.data_vars:
+        da = ds[var]
+        if (da.ndim == 0) or not np.issubdtype(da.dtype, np.floating):
+            continue
+        enc = {'zlib': True, 'complevel': complevel, 'shuffle': True, 'chunksizes': tuple(min(n, chunk_size) for n in da.shape)}
+        if var in INTVARS:
+            enc.update({'dtype': INTVARS[var], '_FillValue': -1})
+        elif pack and (var in QUANTIZATION):
+            scale, offset = get_packing(*QUANTIZATION[var])
+            enc.update({'dtype': 'i2', 'scale_factor': scale, 'add_offset': offset, '_FillValue': np.int16(-2**(NBITS-1))})
+        else:
+            enc.update({'dtype': 'f4', '_FillValue': np.float32(np.nan)})
+            if pack and (var in DECIMALS):
+                enc['least_significant_digit'] = DECIMALS[var]
+        out[var] = enc
+    return out
+
+def get_tile_file(tiledir, i0, j0):
+    out = tiledir + '/tile_' + str(i0).zfill(5) + '_' + str(j0).zfill(5) + '.nc'
+    return out
+
+def check_tile_manifest(tiledir, params):
+    """Keep the tiles of a directory only if they were fitted with the same parameters (written to its manifest.json): tiles of another run are removed"""
+    params = json.loads(json.dumps(params))
+    manifest = tiledir + '/manifest.json'
+    if os.path.isfile(manifest):
+        with open(manifest) as f:
+            if json.load(f) == params:
+                return manifest
+    for tilefile in glob.glob(tiledir + '/tile_*.nc'):
+        os.remove(tilefile)
+    with open(manifest, 'w') as f:
+        json.dump(params, f, indent=2)
+    return manifest
+
+def merge_tiles(files, outfile, postprocess=None):
+    """Put tiles of a regime map back together (postprocess: function applied to the merged dataset before writing)"""
+    tiles = [xr.open_dataset(f) for f in files]
+    ds = xr.combine_by_coords(tiles).sortby(['latitude', 'longitude'])
+    if postprocess is not None:
+        ds = postprocess(ds)
+    ds = ds.load()
+    write_netcdf(ds, outfile, get_encoding(ds))
+    for tile in tiles:
+        tile.close()
+    return outfile
+
+def append_daily_netcdf(da, outfile, variable='ef', complevel=4):
+    """Append a daily field ((latitude, longitude) or (point)) to a NetCDF file with an unlimited time dimension, chunked by day and compressed (or overwrite its day if already stored)"""
+    coords = [c for c in da.coords if (c != 'time') and (len(da[c].dims) > 0)]
+    if not os.path.isfile(outfile):
+        with netCDF4.Dataset(outfile, 'w') as nc:
+            nc.createDimension('time', None)
+            for c in coords:
+                for dim in da[c].dims:
+                    if dim not in nc.dimensions:
+                        nc.createDimension(dim, da.sizes[dim])
+                var = nc.createVariable(c, da[c].dtype, da[c].dims, zlib=True, complevel=complevel)
+                var[:] = da[c].values
+                var.setncatts(da[c].attrs)
+            var = nc.createVariable('time', 'f8', ('time',))
+            var.units = 'days since 1970-01-01'
+            var.calendar = 'standard'
+            if variable in QUANTIZATION:   # packed values are decoded by netCDF4 and xarray readers
+                var = nc.createVariable(variable, 'i2', ('time',) + da.dims, zlib=True, complevel=complevel,
+                                        chunksizes=(1,) + da.shape, fill_value=np.int16(-2**(NBITS-1)))
+                var.scale_factor, var.add_offset = get_packing(*QUANTIZATION[variable])
+            else:
+                var = nc.createVariable(variable, 'f4', ('time',) + da.dims, zlib=True, complevel=complevel,
+                                        chunksizes=(1,) + da.shape, fill_value=np.float32(np.nan))
+            var.setncatts(da.attrs)
+            aux = [c for c in coords if c not in da.dims]
+            if len(aux) > 0:
+                var.coordinates = ' '.join(aux)
+    with netCDF4.Dataset(outfile, 'a') as nc:
+        if not nc.dimensions['time'].isunlimited():   # e.g. written by compute_ef.ipynb
+            raise ValueError('%s has a fixed-size time dimension: days cannot be appended to it (remove the file to rebuild it)'%outfile)
+        time = netCDF4.date2num(pd.Timestamp(da.time.values).to_pydatetime(), nc['time'].units, getattr(nc['time'], 'calendar', 'standard'))   # in the units of the file
+        stored = np.flatnonzero(np.asarray(nc['time'][:]) == time)
+        it = stored[0] if len(stored) > 0 else nc.dimensions['time'].size   # a day already stored is overwritten
+        nc['time'][it] = time
+        valid = np.isfinite(da.values)
+        nc[variable][it] = np.ma.array(np.where(valid, da.values, 0.), mask=~valid)   # missing values -> fill value
+    return outfile
+
+def write_land_points(da, outfile, mask=None, complevel=4):
+    """Write the land columns of a (time, latitude, longitude) field as a compressed (time, point) array"""
+    pts = to_points(da, mask)
+    name = da.name if da.name is not None else 'data'
+    encoding = {name: {'zlib': True, 'complevel': complevel, 'chunksizes': (1, pts.sizes['point'])}}
+    write_netcdf(pts.to_dataset(name=name), outfile, encoding)
+    return outfile